@@ -0,0 +1,269 @@
+"""
+hessian2 性能基准
+
+生成可复现的测试语料，测量 dumps / loads 的吞吐（ops/s、MB/s）、延迟分位数和峰值内存，结果保存为 json，用于比较两个版本之间的性能回退。
+
+用法：
+    python bench/bench_main.py run -o base.json
+    python bench/bench_main.py run -o new.json --corpus dto_list --corpus strings
+    python bench/bench_main.py compare base.json new.json --threshold 0.1
+"""
+import argparse
+import copy
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hessian2 import dumps, loads  # noqa: E402
+
+SEED = 20240101
+
+
+### corpus
+# 每个语料是一个函数，接收 random.Random，返回待序列化的对象，相同的 seed 生成的对象完全一致
+
+def _corpus_small_rpc(rnd: random.Random) -> Any:
+    return {
+        '#class': 'com.example.rpc.Request',
+        'service': 'com.example.UserService',
+        'method': 'getUser',
+        'version': '1.0.%d' % rnd.randint(0, 9),
+        'args': [rnd.randint(0, 1 << 40), 'zh_CN', True],
+        'attachments': {'traceId': '%032x' % rnd.getrandbits(128), 'timeout': 3000},
+    }
+
+
+def _corpus_dto_list(rnd: random.Random) -> Any:
+    def address(i: int) -> dict:
+        return {
+            '#class': 'com.example.dto.Address',
+            'city': rnd.choice(['Beijing', 'Shanghai', 'Shenzhen', 'Hangzhou']),
+            'street': 'No.%d Street' % rnd.randint(1, 999),
+            'zip': '%06d' % rnd.randint(0, 999999),
+        }
+
+    return [{
+        '#class': 'com.example.dto.UserDTO',
+        'id': i,
+        'name': 'user_%d' % i,
+        'age': rnd.randint(18, 80),
+        'score': round(rnd.uniform(0, 100), 2),
+        'active': rnd.random() < 0.5,
+        'address': address(i),
+        'tags': ['tag%d' % rnd.randint(0, 20) for _ in range(rnd.randint(0, 5))],
+    } for i in range(2000)]
+
+
+def _corpus_strings(rnd: random.Random) -> Any:
+    ascii_chars = 'abcdefghijklmnopqrstuvwxyz0123456789 '
+    cjk_chars = '中文日本語한국어测试数据序列化协议'
+    astral_chars = '🚀🌟😊𝄞𠀀𩸽'
+
+    def text(alphabet: str, n: int) -> str:
+        return ''.join(rnd.choice(alphabet) for _ in range(n))
+
+    return {
+        'ascii': [text(ascii_chars, rnd.randint(1, 200)) for _ in range(500)],
+        'cjk': [text(cjk_chars, rnd.randint(1, 200)) for _ in range(500)],
+        'astral': [text(cjk_chars + astral_chars, rnd.randint(1, 50)) for _ in range(200)],
+        'long': text(ascii_chars + cjk_chars, 60000),
+    }
+
+
+def _corpus_large_binary(rnd: random.Random) -> Any:
+    return {'name': 'attachment.bin', 'content': rnd.randbytes(4 * 1024 * 1024)}
+
+
+def _corpus_deep_nesting(rnd: random.Random) -> Any:
+    # 递归实现的编解码受限于 python 的递归深度，此处的深度保持在默认限制以内
+    root = node = {'level': 0}
+    for level in range(1, 150):
+        child = {'level': level, 'siblings': [rnd.randint(0, 100) for _ in range(3)]}
+        node['child'] = child
+        node = child
+    return [copy.deepcopy(root) for _ in range(20)]
+
+
+def _corpus_numeric_series(rnd: random.Random) -> Any:
+    return {
+        'ints': [rnd.randint(-1 << 20, 1 << 20) for _ in range(20000)],
+        'longs': [rnd.randint(-1 << 62, 1 << 62) for _ in range(5000)],
+        'doubles': [rnd.uniform(-1e6, 1e6) for _ in range(20000)],
+        'prices': [rnd.randint(0, 10 ** 6) / 100 for _ in range(20000)],
+        'dates': [datetime.datetime(2024, 1, 1) + datetime.timedelta(seconds=rnd.randint(0, 10 ** 8)) for _ in range(2000)],
+    }
+
+
+CORPORA: Dict[str, Callable[[random.Random], Any]] = {
+    'small_rpc': _corpus_small_rpc,
+    'dto_list': _corpus_dto_list,
+    'strings': _corpus_strings,
+    'large_binary': _corpus_large_binary,
+    'deep_nesting': _corpus_deep_nesting,
+    'numeric_series': _corpus_numeric_series,
+}
+
+
+def build_corpus(name: str, seed: int = SEED) -> Any:
+    return CORPORA[name](random.Random(seed))
+
+
+### measure
+
+def _percentile(sorted_values: List[float], p: float) -> float:
+    idx = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def _summarize(latencies: List[float], payload_size: int) -> dict:
+    latencies.sort()
+    total = sum(latencies)
+    return {
+        'iterations': len(latencies),
+        'ops_per_sec': len(latencies) / total if total else 0.0,
+        'mb_per_sec': len(latencies) * payload_size / total / 1e6 if total else 0.0,
+        'latency_us': {
+            'min': latencies[0] * 1e6,
+            'p50': _percentile(latencies, 50) * 1e6,
+            'p90': _percentile(latencies, 90) * 1e6,
+            'p99': _percentile(latencies, 99) * 1e6,
+            'max': latencies[-1] * 1e6,
+        },
+    }
+
+
+def _peak_memory(fn: Callable[[], Any]) -> int:
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def bench_corpus(name: str, min_time: float, min_iterations: int) -> dict:
+    value = build_corpus(name)
+    encoded = dumps(value)
+
+    dumps_latencies = []
+    deadline = time.perf_counter() + min_time
+    while len(dumps_latencies) < min_iterations or time.perf_counter() < deadline:
+        start = time.perf_counter()
+        dumps(value)
+        dumps_latencies.append(time.perf_counter() - start)
+
+    loads_latencies = []
+    deadline = time.perf_counter() + min_time
+    while len(loads_latencies) < min_iterations or time.perf_counter() < deadline:
+        start = time.perf_counter()
+        loads(encoded)
+        loads_latencies.append(time.perf_counter() - start)
+
+    return {
+        'payload_bytes': len(encoded),
+        'dumps': dict(_summarize(dumps_latencies, len(encoded)), peak_memory_bytes=_peak_memory(lambda: dumps(value))),
+        'loads': dict(_summarize(loads_latencies, len(encoded)), peak_memory_bytes=_peak_memory(lambda: loads(encoded))),
+    }
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run(corpora: List[str], min_time: float, min_iterations: int) -> dict:
+    results = {}
+    for name in corpora:
+        results[name] = bench_corpus(name, min_time, min_iterations)
+        print('%-16s dumps %10.1f ops/s %8.2f MB/s | loads %10.1f ops/s %8.2f MB/s' % (
+            name,
+            results[name]['dumps']['ops_per_sec'], results[name]['dumps']['mb_per_sec'],
+            results[name]['loads']['ops_per_sec'], results[name]['loads']['mb_per_sec'],
+        ), file=sys.stderr)
+    return {
+        'meta': {
+            'revision': _git_revision(),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'seed': SEED,
+        },
+        'results': results,
+    }
+
+
+### compare
+
+def compare(base: dict, new: dict, threshold: float) -> List[str]:
+    """
+    比较两次结果，返回回退项的描述。吞吐下降或峰值内存上升超过 threshold（相对比例）视为回退
+    """
+    regressions = []
+    for name, new_result in new['results'].items():
+        base_result = base['results'].get(name)
+        if base_result is None:
+            continue
+        for op in ('dumps', 'loads'):
+            b, n = base_result[op], new_result[op]
+            for metric, higher_is_better in (('ops_per_sec', True), ('peak_memory_bytes', False)):
+                if not b[metric]:
+                    continue
+                change = (n[metric] - b[metric]) / b[metric]
+                regressed = change < -threshold if higher_is_better else change > threshold
+                line = '%-16s %-6s %-18s %14.1f -> %14.1f (%+.1f%%)%s' % (
+                    name, op, metric, b[metric], n[metric], change * 100, '  REGRESSION' if regressed else '')
+                print(line)
+                if regressed:
+                    regressions.append(line.strip())
+    return regressions
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='hessian2 benchmark')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = sub.add_parser('run', help='run benchmarks and save results as json')
+    run_parser.add_argument('-o', '--output', help='result file, default stdout')
+    run_parser.add_argument('--corpus', action='append', choices=sorted(CORPORA), help='corpus to run, default all')
+    run_parser.add_argument('--min-time', type=float, default=1.0, help='minimum seconds per operation')
+    run_parser.add_argument('--min-iterations', type=int, default=5, help='minimum iterations per operation')
+
+    compare_parser = sub.add_parser('compare', help='compare two result files and flag regressions')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='relative change treated as regression')
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        result = run(args.corpus or list(CORPORA), args.min_time, args.min_iterations)
+        text = json.dumps(result, indent=2)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(text)
+        else:
+            print(text)
+        return 0
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    return 1 if compare(base, new, args.threshold) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
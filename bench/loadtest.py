@@ -0,0 +1,455 @@
+"""
+hessian2 并发压测
+
+在本机启动 hessian echo 服务（loads 后再 dumps），多个客户端按目标速率重放语料，统计吞吐、延迟分位数、每个消息的 cpu 时间，
+以及服务端和客户端 RSS 随时间的变化，用于观察编解码的改动对长尾延迟和多核扩展性的影响。只支持 linux（依赖 fork 和 /proc）。
+
+协议：每个消息前加 4 字节大端长度，服务端对每个请求返回一个消息。
+
+用法：
+    python bench/loadtest.py run --clients 8 --rate 2000 --duration 10
+    python bench/loadtest.py run --server-workers 4 --client-mode process --clients 16 -o result.json
+    python bench/loadtest.py run --client-mode asyncio --clients 64 --corpus small_rpc --payload request.bin
+    python bench/loadtest.py serve --port 9090 --workers 4 --mode transform
+    python bench/loadtest.py run --connect 127.0.0.1:9090 --server-pid 1234
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+from typing import Any, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hessian2 import dumps, loads, loads_tracked  # noqa: E402
+from bench_main import CORPORA, SEED, _git_revision, _percentile, build_corpus  # noqa: E402
+
+_HEADER = struct.Struct('>I')
+_CLK_TCK = os.sysconf('SC_CLK_TCK')
+
+
+### server
+# echo：loads 后直接 dumps；transform：修改顶层 map 的一个字段后 dumps；tracked：同 transform，使用 loads_tracked 重新序列化
+
+def _stamp(v: Any) -> None:
+    if isinstance(v, dict):
+        v['servedBy'] = os.getpid()
+
+
+def handle_message(data: bytes, mode: str) -> bytes:
+    if mode == 'echo':
+        return dumps(loads(data))
+    if mode == 'tracked':
+        m = loads_tracked(data)
+        _stamp(m.value)
+        return m.dumps()
+    v = loads(data)
+    _stamp(v)
+    return dumps(v)
+
+
+def _read_frame(f) -> Optional[bytes]:
+    header = f.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        return None
+    n, = _HEADER.unpack(header)
+    data = f.read(n)
+    if len(data) < n:
+        return None
+    return data
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self) -> None:
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with sock.makefile('rb') as f:
+            while True:
+                data = _read_frame(f)
+                if data is None:
+                    return
+                out = handle_message(data, self.server.mode)
+                sock.sendall(_HEADER.pack(len(out)) + out)
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    mode = 'echo'
+
+
+def _serve(sock: socket.socket, mode: str) -> None:
+    # 多个 worker 进程共享 fork 前创建的监听 socket，由内核分配连接
+    server = _Server(sock.getsockname(), _Handler, bind_and_activate=False)
+    server.socket.close()
+    server.socket = sock
+    server.mode = mode
+    server.serve_forever()
+
+
+def start_server(host: str, port: int, workers: int, mode: str) -> Tuple[Tuple[str, int], List[multiprocessing.Process]]:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.setblocking(False)  # 其他 worker 先 accept 时不阻塞
+
+    ctx = multiprocessing.get_context('fork')
+    processes = [ctx.Process(target=_serve, args=(sock, mode), daemon=True) for _ in range(workers)]
+    for p in processes:
+        p.start()
+    address = sock.getsockname()
+    sock.close()
+    return address, processes
+
+
+### client
+
+class _Schedule:
+    """
+    按固定间隔安排发送时间（开环），interval 为 0 时收到响应后立即发送下一个（闭环）。
+    延迟从计划的发送时间开始计算，发送被前一个慢请求推迟的时间也计入延迟
+    """
+
+    def __init__(self, interval: float, start_at: float, measure_at: float, deadline: float):
+        self.interval = interval
+        self.measure_at = measure_at
+        self.deadline = deadline
+        self.next_at = start_at
+        self.latencies: List[float] = []
+        self.bytes = 0
+        self.errors = 0
+        self.finished_at = start_at
+
+    def next_send(self) -> Optional[float]:
+        # 返回计划的发送时间，到达截止时间后返回 None
+        if not self.interval:
+            return max(self.next_at, time.monotonic()) if time.monotonic() < self.deadline else None
+        if self.next_at >= self.deadline:
+            return None
+        sent_at = self.next_at
+        self.next_at += self.interval
+        return sent_at
+
+    def record(self, sent_at: float, size: int) -> None:
+        if sent_at >= self.measure_at:
+            self.finished_at = time.monotonic()
+            self.latencies.append(self.finished_at - sent_at)
+            self.bytes += size
+
+    def result(self) -> dict:
+        return {'latencies': self.latencies, 'bytes': self.bytes, 'errors': self.errors, 'finished_at': self.finished_at}
+
+
+def _client_loop(address: Tuple[str, int], payloads: List[bytes], offset: int, schedule: _Schedule) -> dict:
+    try:
+        with socket.create_connection(address) as sock:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with sock.makefile('rb') as f:
+                i = offset
+                while True:
+                    sent_at = schedule.next_send()
+                    if sent_at is None:
+                        break
+                    delay = sent_at - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    payload = payloads[i % len(payloads)]
+                    i += 1
+                    sock.sendall(_HEADER.pack(len(payload)) + payload)
+                    if _read_frame(f) is None:
+                        raise ConnectionError('connection closed by server')
+                    schedule.record(sent_at, len(payload))
+    except OSError:
+        schedule.errors += 1
+    return schedule.result()
+
+
+def _client_process(queue: multiprocessing.Queue, address: Tuple[str, int], payloads: List[bytes], offset: int, schedule: _Schedule) -> None:
+    queue.put(_client_loop(address, payloads, offset, schedule))
+
+
+async def _async_client(address: Tuple[str, int], payloads: List[bytes], offset: int, schedule: _Schedule) -> dict:
+    try:
+        reader, writer = await asyncio.open_connection(*address)
+    except OSError:
+        schedule.errors += 1
+        return schedule.result()
+    writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    try:
+        i = offset
+        while True:
+            sent_at = schedule.next_send()
+            if sent_at is None:
+                break
+            delay = sent_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            payload = payloads[i % len(payloads)]
+            i += 1
+            writer.write(_HEADER.pack(len(payload)) + payload)
+            await writer.drain()
+            n, = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+            await reader.readexactly(n)
+            schedule.record(sent_at, len(payload))
+    except (OSError, asyncio.IncompleteReadError):
+        schedule.errors += 1
+    finally:
+        writer.close()
+    return schedule.result()
+
+
+def _run_async_clients(address: Tuple[str, int], payloads: List[bytes], schedules: List[_Schedule]) -> List[dict]:
+    async def run_all() -> List[dict]:
+        return await asyncio.gather(*(_async_client(address, payloads, i, s) for i, s in enumerate(schedules)))
+
+    return asyncio.run(run_all())
+
+
+### monitor
+
+def _proc_rss(pid: int) -> Optional[int]:
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _proc_cpu(pid: int) -> Optional[float]:
+    # utime + stime，单位秒，包括进程中的所有线程
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / _CLK_TCK
+
+
+def _total(values: List[Optional[float]]) -> Optional[float]:
+    values = [v for v in values if v is not None]
+    return sum(values) if values else None
+
+
+class _Monitor(threading.Thread):
+    """
+    每隔 interval 秒记录一次服务端和客户端进程的 RSS 和 cpu 使用率
+    """
+
+    def __init__(self, server_pids: List[int], client_pids: List[int], interval: float):
+        super().__init__(daemon=True)
+        self.server_pids = server_pids
+        self.client_pids = client_pids
+        self.interval = interval
+        self.timeline: List[dict] = []
+        self._stopped = threading.Event()
+
+    def cpu(self) -> Tuple[Optional[float], Optional[float]]:
+        return _total([_proc_cpu(pid) for pid in self.server_pids]), _total([_proc_cpu(pid) for pid in self.client_pids])
+
+    def run(self) -> None:
+        start = time.monotonic()
+        last_time, last_cpu = start, self.cpu()
+        while not self._stopped.wait(self.interval):
+            now, cpu = time.monotonic(), self.cpu()
+            self.timeline.append({
+                't': round(now - start, 3),
+                'server_rss_bytes': _total([_proc_rss(pid) for pid in self.server_pids]),
+                'client_rss_bytes': _total([_proc_rss(pid) for pid in self.client_pids]),
+                'server_cpu_percent': None if cpu[0] is None or last_cpu[0] is None else (cpu[0] - last_cpu[0]) / (now - last_time) * 100,
+                'client_cpu_percent': None if cpu[1] is None or last_cpu[1] is None else (cpu[1] - last_cpu[1]) / (now - last_time) * 100,
+            })
+            last_time, last_cpu = now, cpu
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self.join()
+
+
+### run
+
+def load_payloads(corpora: List[str], files: List[str]) -> List[bytes]:
+    payloads = [dumps(build_corpus(name)) for name in corpora]
+    for filename in files:
+        with open(filename, 'rb') as f:
+            payloads.append(f.read())
+    return payloads
+
+
+def _sleep_until(t: float) -> None:
+    delay = t - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+
+
+def run(address: Optional[Tuple[str, int]], payloads: List[bytes], clients: int, client_mode: str, rate: float, duration: float,
+        warmup: float, server_workers: int, server_mode: str, server_pids: List[int], sample_interval: float) -> dict:
+    servers = []
+    if address is None:
+        address, servers = start_server('127.0.0.1', 0, server_workers, server_mode)
+        server_pids = [p.pid for p in servers]
+
+    # 所有客户端在同一时刻开始，目标速率平均分配给每个客户端，发送时间相互错开
+    interval = clients / rate if rate else 0.0
+    start_at = time.monotonic() + 0.5
+    measure_at = start_at + warmup
+    deadline = measure_at + duration
+    schedules = [_Schedule(interval, start_at + interval * i / clients, measure_at, deadline) for i in range(clients)]
+
+    ctx = multiprocessing.get_context('fork')
+    results: List[dict] = []
+    workers: List[Any] = []
+    queue = ctx.Queue()
+    if client_mode == 'process':
+        workers = [ctx.Process(target=_client_process, args=(queue, address, payloads, i, s), daemon=True) for i, s in enumerate(schedules)]
+    elif client_mode == 'thread':
+        workers = [threading.Thread(target=lambda i=i, s=s: results.append(_client_loop(address, payloads, i, s)), daemon=True)
+                   for i, s in enumerate(schedules)]
+    else:
+        workers = [threading.Thread(target=lambda: results.extend(_run_async_clients(address, payloads, schedules)), daemon=True)]
+    for w in workers:
+        w.start()
+
+    client_pids = [w.pid for w in workers] if client_mode == 'process' else [os.getpid()]
+    monitor = _Monitor(server_pids, client_pids, sample_interval)
+    monitor.start()
+    try:
+        _sleep_until(measure_at)
+        cpu_start = monitor.cpu()
+        _sleep_until(deadline)
+        cpu_end = monitor.cpu()
+        if client_mode == 'process':
+            results = [queue.get() for _ in workers]
+        for w in workers:
+            w.join()
+    finally:
+        monitor.stop()
+        for p in servers:
+            p.terminate()
+            p.join()
+
+    latencies = sorted(latency for r in results for latency in r['latencies'])
+    messages = len(latencies)
+    payload_bytes = sum(r['bytes'] for r in results)
+    # 服务端跟不上目标速率时积压的请求在截止时间之后才完成，吞吐按实际耗时计算
+    elapsed = max([duration] + [r['finished_at'] - measure_at for r in results])
+
+    def cpu_per_message(i: int) -> Optional[float]:
+        if cpu_start[i] is None or cpu_end[i] is None or not messages:
+            return None
+        return (cpu_end[i] - cpu_start[i]) / messages * 1e6
+
+    result = {
+        'messages': messages,
+        'errors': sum(r['errors'] for r in results),
+        'elapsed': elapsed,
+        'ops_per_sec': messages / elapsed,
+        'mb_per_sec': payload_bytes / elapsed / 1e6,
+        'latency_us': {
+            'min': latencies[0] * 1e6,
+            'p50': _percentile(latencies, 50) * 1e6,
+            'p90': _percentile(latencies, 90) * 1e6,
+            'p99': _percentile(latencies, 99) * 1e6,
+            'p999': _percentile(latencies, 99.9) * 1e6,
+            'max': latencies[-1] * 1e6,
+        } if latencies else None,
+        'server_cpu_us_per_message': cpu_per_message(0),
+        'client_cpu_us_per_message': cpu_per_message(1),
+    }
+    return {
+        'meta': {
+            'revision': _git_revision(),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'seed': SEED,
+        },
+        'config': {
+            'address': '%s:%d' % tuple(address),
+            'clients': clients,
+            'client_mode': client_mode,
+            'rate': rate,
+            'duration': duration,
+            'warmup': warmup,
+            'server_workers': len(server_pids) or None,
+            'server_mode': server_mode if servers else None,
+            'payloads': len(payloads),
+        },
+        'result': result,
+        'timeline': monitor.timeline,
+    }
+
+
+def _parse_address(text: str) -> Tuple[str, int]:
+    host, _, port = text.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='hessian2 load test')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = sub.add_parser('serve', help='run the echo server until interrupted')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=9090)
+    serve_parser.add_argument('--workers', type=int, default=1, help='server processes sharing the listening socket')
+    serve_parser.add_argument('--mode', choices=('echo', 'transform', 'tracked'), default='echo')
+
+    run_parser = sub.add_parser('run', help='replay payloads against the echo server and report latency and resource usage')
+    run_parser.add_argument('-o', '--output', help='result file, default stdout')
+    run_parser.add_argument('--connect', type=_parse_address, help='host:port of a running server, default start one locally')
+    run_parser.add_argument('--server-pid', type=int, action='append', default=[], help='pid of the running server for cpu / rss stats')
+    run_parser.add_argument('--server-workers', type=int, default=1, help='server processes when started locally')
+    run_parser.add_argument('--server-mode', choices=('echo', 'transform', 'tracked'), default='echo')
+    run_parser.add_argument('--corpus', action='append', choices=sorted(CORPORA), help='corpus to replay, default small_rpc')
+    run_parser.add_argument('--payload', action='append', default=[], help='file containing one encoded message to replay')
+    run_parser.add_argument('--clients', type=int, default=4, help='concurrent connections')
+    run_parser.add_argument('--client-mode', choices=('thread', 'process', 'asyncio'), default='thread')
+    run_parser.add_argument('--rate', type=float, default=0, help='total messages per second, 0 sends as fast as possible')
+    run_parser.add_argument('--duration', type=float, default=10.0, help='measured seconds')
+    run_parser.add_argument('--warmup', type=float, default=1.0, help='seconds excluded from the result')
+    run_parser.add_argument('--sample-interval', type=float, default=1.0, help='seconds between rss / cpu samples')
+
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        address, processes = start_server(args.host, args.port, args.workers, args.mode)
+        print('listening on %s:%d, pids %s' % (address[0], address[1], ' '.join(str(p.pid) for p in processes)), file=sys.stderr)
+        try:
+            for p in processes:
+                p.join()
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    corpora = args.corpus or ([] if args.payload else ['small_rpc'])
+    result = run(args.connect, load_payloads(corpora, args.payload), args.clients, args.client_mode, args.rate, args.duration,
+                 args.warmup, args.server_workers, args.server_mode, args.server_pid, args.sample_interval)
+    r = result['result']
+    if r['latency_us']:
+        print('%d msgs %10.1f ops/s %8.2f MB/s | p50 %8.1f us p99 %8.1f us p999 %8.1f us | errors %d' % (
+            r['messages'], r['ops_per_sec'], r['mb_per_sec'],
+            r['latency_us']['p50'], r['latency_us']['p99'], r['latency_us']['p999'], r['errors'],
+        ), file=sys.stderr)
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    return 1 if r['errors'] or not r['messages'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
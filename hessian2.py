@@ -1,8 +1,20 @@
-from collections import UserList
-from dataclasses import dataclass
-from datetime import datetime
+import sys
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from dataclasses import dataclass, fields, is_dataclass
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from itertools import chain, repeat
+from keyword import iskeyword
+from math import inf, isfinite
+from operator import attrgetter, is_
+from os import cpu_count
+from reprlib import recursive_repr
+from threading import Lock
 from struct import pack, unpack
-from typing import Any, List, Dict, Sequence, Union
+from time import perf_counter
+from typing import Any, Callable, Collection, Generator, List, Dict, NamedTuple, Optional, Sequence, Tuple, Union
 
 try:
     import py3_hessian2_rsimpl
@@ -15,8 +27,8 @@ Hessian 2.0 Protocol
 see http://hessian.caucho.com/doc/hessian-serialization.html
 
 Hessian Bytecode map:
-    x00 - x1f    # utf-8 string length 0-32
-    x20 - x2f    # binary data length 0-16
+    x00 - x1f    # utf-8 string length 0-31
+    x20 - x2f    # binary data length 0-15
     x30 - x33    # utf-8 string length 0-1023
     x34 - x37    # binary data length 0-1023
     x38 - x3f    # three-octet compact long (-x40000 to x3ffff)
@@ -63,6 +75,32 @@ Hessian Bytecode map:
 """
 
 
+class DateMode:
+    """
+    反序列化时 date 的表示方式，通过 loads / Hessian2Deserializer 的 dates 参数指定
+    """
+    DATETIME = 'datetime'  # 本地时区的 naive datetime（默认）
+    UTC = 'utc'  # UTC 时区的 aware datetime
+    MILLIS = 'millis'  # epoch 毫秒数 int，不做任何转换，最快
+
+
+_UTC_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+_DATE_CONVERTERS: Dict[str, Callable[[int], Any]] = {
+    DateMode.DATETIME: lambda ms: datetime.fromtimestamp(ms / 1000),
+    DateMode.UTC: lambda ms: _UTC_EPOCH + timedelta(milliseconds=ms),
+    DateMode.MILLIS: lambda ms: ms,
+}
+
+
+def to_datetime64(millis: Sequence[int]) -> Any:
+    """
+    将 epoch 毫秒数批量转换为 numpy datetime64[ms] 数组，配合 loads(data, dates=DateMode.MILLIS) 使用，需要安装 numpy
+    """
+    import numpy
+    return numpy.asarray(millis, dtype='int64').astype('datetime64[ms]')
+
+
 class TypeConstants:
     BOOLEAN_ARRAY = '[boolean'
     SHORT_ARRAY = '[short'
@@ -74,6 +112,437 @@ class TypeConstants:
     OBJECT_ARRAY = '[object'
 
 
+def _build_tag_families() -> Tuple[str, ...]:
+    # 每个 tag 字节所属的类型，与上面的 Hessian Bytecode map 对应
+    families = ['reserved'] * 256
+    for lo, hi, family in (
+            (0x00, 0x1f, 'string'), (0x20, 0x2f, 'binary'), (0x30, 0x33, 'string'), (0x34, 0x37, 'binary'),
+            (0x38, 0x3f, 'long'), (0x41, 0x42, 'binary'), (0x43, 0x43, 'class_def'), (0x44, 0x44, 'double'),
+            (0x46, 0x46, 'boolean'), (0x48, 0x48, 'map'), (0x49, 0x49, 'int'), (0x4a, 0x4b, 'date'),
+            (0x4c, 0x4c, 'long'), (0x4d, 0x4d, 'map'), (0x4e, 0x4e, 'null'), (0x4f, 0x4f, 'object'),
+            (0x51, 0x51, 'ref'), (0x52, 0x53, 'string'), (0x54, 0x54, 'boolean'), (0x55, 0x58, 'list'),
+            (0x59, 0x59, 'long'), (0x5b, 0x5f, 'double'), (0x60, 0x6f, 'object'), (0x70, 0x7f, 'list'),
+            (0x80, 0xd7, 'int'), (0xd8, 0xff, 'long'),
+    ):
+        families[lo:hi + 1] = [family] * (hi - lo + 1)
+    return tuple(families)
+
+
+_TAG_FAMILIES = _build_tag_families()
+
+
+class TypedList(list):
+    """
+    带类型的 list，java 类型保存在 cls_name 中
+
+    兼容原先使用 UserList 时的 l.__dict__['#class'] 和 l.data 写法，修改 l.__dict__['#class'] 即修改 cls_name
+    """
+    __slots__ = ('cls_name',)
+
+    def __init__(self, iterable=(), cls_name: str = None):
+        super().__init__(iterable)
+        self.cls_name = cls_name
+
+    @property
+    def __dict__(self) -> MutableMapping:
+        return _TypedListAttrs(self)
+
+    @property
+    def data(self) -> list:
+        return self
+
+    def __reduce__(self):
+        # 元素通过 extend 恢复，支持包含自身的 list
+        return TypedList, ((), self.cls_name), None, iter(self)
+
+
+class _TypedListAttrs(MutableMapping):
+    """
+    TypedList.__dict__ 返回的视图，cls_name 不为 None 时只有 '#class' 一个 key，读写都直接作用于 cls_name
+    """
+    __slots__ = ('_list',)
+
+    def __init__(self, l: TypedList):
+        self._list = l
+
+    def __getitem__(self, key: str) -> Any:
+        if key != '#class' or self._list.cls_name is None:
+            raise KeyError(key)
+        return self._list.cls_name
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key != '#class':
+            raise KeyError(f'TypedList has no attribute {key}')
+        self._list.cls_name = value
+
+    def __delitem__(self, key: str) -> None:
+        raise TypeError(f'can not delete {key} of TypedList')
+
+    def __iter__(self):
+        return iter(('#class',) if self._list.cls_name is not None else ())
+
+    def __len__(self) -> int:
+        return int(self._list.cls_name is not None)
+
+    def __repr__(self) -> str:
+        return repr(dict(self.items()))
+
+
+class Hessian2Record(MutableMapping):
+    """
+    loads(data, records=True) 时 object 反序列化为该类型，每个 class 定义对应一个子类，字段保存在 __slots__ 中，
+    同一个类的对象共享字段布局，比 dict 节省内存
+
+    实现 dict 的读写接口，'#class' 也是其中的一个 key，但不能增加或删除字段。字段名是合法的标识符且不与方法重名时也可以作为属性访问
+    """
+    __slots__ = ()
+    _cls_name: str = None
+    _field_names: Tuple[str, ...] = ()  # class 定义中的字段名，可能重复
+    _slot_names: Dict[str, str] = {}  # 字段名 -> slot 名
+    _keys: Tuple[str, ...] = ('#class',)
+
+    def __getitem__(self, key: str) -> Any:
+        if key == '#class':
+            return self._cls_name
+        try:
+            return getattr(self, self._slot_names[key])
+        except (KeyError, AttributeError):
+            raise KeyError(key) from None
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        slot_name = self._slot_names.get(key)
+        if slot_name is None:
+            raise KeyError(f'{self._cls_name} has no field {key}')
+        setattr(self, slot_name, value)
+
+    def __delitem__(self, key: str) -> None:
+        raise TypeError(f'can not delete field {key} of {self._cls_name}')
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    @recursive_repr()
+    def __repr__(self) -> str:
+        return repr(dict(self.items()))
+
+    def __reduce__(self):
+        slots = {slot_name: getattr(self, slot_name) for slot_name in self._slot_names.values() if hasattr(self, slot_name)}
+        return _new_record, (self._cls_name, self._field_names), (None, slots)
+
+
+@lru_cache(maxsize=1024)
+def _record_type(cls_name: str, field_names: Tuple[str, ...]) -> type:
+    slot_names = {}
+    for name in field_names:
+        if name not in slot_names:
+            usable = name.isidentifier() and not iskeyword(name) and not name.startswith('_') and not hasattr(Hessian2Record, name)
+            slot_names[name] = name if usable else f'_f{len(slot_names)}'
+    return type(cls_name.rsplit('.', 1)[-1], (Hessian2Record,), {
+        '__slots__': tuple(slot_names.values()),
+        '__module__': __name__,
+        '_cls_name': cls_name,
+        '_field_names': field_names,
+        '_slot_names': slot_names,
+        '_keys': ('#class',) + tuple(slot_names),
+    })
+
+
+def _new_record(cls_name: str, field_names: Tuple[str, ...]) -> Hessian2Record:
+    return _record_type(cls_name, field_names)()
+
+
+@dataclass(frozen=True)
+class _ClassPlan:
+    java_class: Optional[str]  # 为 None 时写出为不带类型的 map
+    field_names: Tuple[str, ...]
+    values: Callable[[Any], Sequence[Any]]  # 按 field_names 的顺序返回字段值
+
+
+_CLASS_REGISTRY: Dict[type, Tuple[str, Optional[Tuple[str, ...]]]] = {}  # python 类型 -> (java 类名, 字段名)
+
+
+def register_class(cls: type, java_class: str, fields: Sequence[str] = None) -> None:
+    """
+    指定 dataclass、__slots__ 类或 namedtuple 序列化时使用的 java 类名，fields 可以指定写出哪些字段及其顺序，默认为全部字段
+
+    也可以在类上定义 __java_class__ 属性
+    """
+    _CLASS_REGISTRY[cls] = (java_class, tuple(fields) if fields is not None else None)
+    _class_plan.cache_clear()
+
+
+@lru_cache(maxsize=None)
+def _class_plan(cls: type) -> Optional[_ClassPlan]:
+    # 每个类型只计算一次，返回 None 表示不是可以直接序列化的类型
+    if issubclass(cls, _INTERNAL_DATACLASSES):
+        return None
+    java_class, field_names = _CLASS_REGISTRY.get(cls, (getattr(cls, '__java_class__', None), None))
+    if issubclass(cls, tuple) and hasattr(cls, '_fields'):
+        if not java_class:
+            return None  # 未指定类名的 namedtuple 仍然作为 list 写出
+        attr_names = field_names or cls._fields
+    elif is_dataclass(cls):
+        attr_names = field_names or tuple(f.name for f in fields(cls))
+    elif hasattr(cls, '__slots__') and java_class:
+        attr_names = field_names or tuple(_slot_names_of(cls))
+    else:
+        return None
+
+    names = tuple(_unmangle(cls, name) for name in attr_names)
+    if attr_names == getattr(cls, '_fields', None):
+        values = tuple  # namedtuple 本身就是按字段顺序排列的值
+    elif len(attr_names) == 1:
+        values = (lambda getter: lambda v: (getter(v),))(attrgetter(attr_names[0]))
+    elif attr_names:
+        values = attrgetter(*attr_names)
+    else:
+        values = lambda v: ()
+    return _ClassPlan(str(java_class) if java_class else None, names, values)
+
+
+def _slot_names_of(cls: type) -> List[str]:
+    # 按继承顺序收集所有 __slots__，私有名称需要按 python 规则改写后才能通过 getattr 访问
+    names = []
+    for klass in reversed(cls.__mro__):
+        slots = klass.__dict__.get('__slots__', ())
+        for slot in (slots,) if isinstance(slots, str) else slots:
+            if slot in ('__dict__', '__weakref__'):
+                continue
+            if slot.startswith('__') and not slot.endswith('__'):
+                slot = f'_{klass.__name__.lstrip("_")}{slot}'
+            if slot not in names:
+                names.append(slot)
+    return names
+
+
+def _unmangle(cls: type, attr_name: str) -> str:
+    # 写出的字段名使用源码中的名称
+    for klass in cls.__mro__:
+        prefix = f'_{klass.__name__.lstrip("_")}__'
+        if attr_name.startswith(prefix):
+            return attr_name[len(prefix) - 2:]
+    return attr_name
+
+
+def _class_name_of(v: Any) -> Optional[str]:
+    if isinstance(v, dict):
+        return v.get('#class')
+    if isinstance(v, Hessian2Record):
+        return v._cls_name
+    if hasattr(v, '__dict__') and '#class' in v.__dict__:
+        return v.__dict__['#class']
+    plan = _class_plan(type(v))
+    return plan.java_class if plan else None
+
+
+class Hessian2LimitError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class Hessian2Limits:
+    """
+    反序列化的资源限制，通过 loads / Hessian2Deserializer 的 limits 参数指定，为 None 的项不限制，超出时抛出 Hessian2LimitError
+
+    无论是否指定 limits，定长 list 声明的长度超过剩余字节数时都会直接报错，不会预先分配
+    """
+    max_depth: Optional[int] = None  # 容器嵌套深度
+    max_container_length: Optional[int] = None  # list 元素个数 / map 键值对个数
+    max_string_length: Optional[int] = None  # 单个字符串的字符数
+    max_binary_length: Optional[int] = None  # 单个 binary 的字节数
+    max_total_bytes: Optional[int] = None  # 所有字符串和 binary 解码后的总字节数
+    max_refs: Optional[int] = None  # ref 表大小
+    max_class_definitions: Optional[int] = None  # class 定义表大小
+    max_type_names: Optional[int] = None  # type 表大小
+
+
+class Hessian2Stats:
+    """
+    序列化 / 反序列化统计，通过 stats 参数传给 dumps / loads / Hessian2Serializer / Hessian2Deserializer
+
+    按 tag 类型统计值的个数、字节数和耗时（不含子元素），按 java 类名统计个数、字节数和耗时（含子元素），
+    以及 ref 命中次数和 class 定义表、type 表的大小。一个 Hessian2Stats 可以在多次调用之间共享，数据累加
+
+    每个顶层值处理完成后，如果指定了 callback，会以 snapshot() 的结果调用 callback
+
+    未启用时不产生任何开销：统计是在构造时替换实例上的 write / read 以及显式栈中开始、结束容器的方法实现的，主流程中没有额外的判断
+    """
+
+    def __init__(self, callback: Callable[[dict], None] = None):
+        self.callback = callback
+        self.reset()
+
+    def reset(self) -> None:
+        self.messages = 0
+        self.tags: Dict[str, List] = {}  # family -> [count, bytes, seconds]
+        self.classes: Dict[str, List] = {}  # java 类名 -> [count, bytes, seconds]
+        self.class_definitions = 0
+        self.type_names = 0
+        self.max_class_definitions = 0
+        self.max_type_names = 0
+
+    def snapshot(self) -> dict:
+        def counters(d: Dict[str, List]) -> dict:
+            return {k: {'count': v[0], 'bytes': v[1], 'seconds': v[2]} for k, v in d.items()}
+
+        return {
+            'messages': self.messages,
+            'tags': counters(self.tags),
+            'classes': counters(self.classes),
+            'ref_hits': self.tags['ref'][0] if 'ref' in self.tags else 0,
+            'class_definitions': self.class_definitions,
+            'type_names': self.type_names,
+            'max_class_definitions': self.max_class_definitions,
+            'max_type_names': self.max_type_names,
+        }
+
+    def _add(self, table: Dict[str, List], key: str, n_bytes: int, seconds: float) -> None:
+        counter = table.get(key)
+        if counter is None:
+            table[key] = [1, n_bytes, seconds]
+        else:
+            counter[0] += 1
+            counter[1] += n_bytes
+            counter[2] += seconds
+
+    def _merge(self, other: 'Hessian2Stats') -> None:
+        # 合并 dumps_parallel 子进程中的统计，消息数和表大小由主进程记录
+        for table, other_table in ((self.tags, other.tags), (self.classes, other.classes)):
+            for key, (count, n_bytes, seconds) in other_table.items():
+                counter = table.setdefault(key, [0, 0, 0.0])
+                counter[0] += count
+                counter[1] += n_bytes
+                counter[2] += seconds
+
+    def _merge_marks(self, fragment: 'RawHessian', mark_sizes: List[Tuple[int, bool]], mark_classes: List[Tuple[str, ...]]) -> None:
+        # 子进程中每个占位标记按 1 字节统计，主进程拼接后按实际写出的字节数修正。第一次使用的 class 定义写在 object 之前，该 object 计为 class_def
+        for (offset, kind, _), (n_bytes, new_class_def), cls_names in zip(fragment.marks, mark_sizes, mark_classes):
+            if kind == _MARK_CLASS and new_class_def:
+                counter = self.tags['object']
+                counter[0] -= 1
+                counter[1] -= 1
+                if not counter[0]:
+                    del self.tags['object']
+                self._add(self.tags, 'class_def', n_bytes, 0.0)
+            else:
+                family = 'ref' if kind == _MARK_REF else 'object' if kind == _MARK_CLASS else _TAG_FAMILIES[fragment.data[offset - 1]]
+                self.tags[family][1] += n_bytes - 1
+            for cls_name in cls_names:
+                self.classes[cls_name][1] += n_bytes - 1
+
+    def _end_message(self, class_definitions: int, type_names: int) -> None:
+        self.messages += 1
+        self.class_definitions = class_definitions
+        self.type_names = type_names
+        self.max_class_definitions = max(self.max_class_definitions, class_definitions)
+        self.max_type_names = max(self.max_type_names, type_names)
+        if self.callback:
+            self.callback(self.snapshot())
+
+    def _probe(self, byte_at: Callable[[int], int], pos: Callable[[], int], cls_name_before: bool,
+               tables: Callable[[], Tuple[int, int]]) -> '_StatsProbe':
+        return _StatsProbe(self, byte_at, pos, cls_name_before, tables)
+
+
+class _StatsProbe:
+    """
+    一个 Hessian2Serializer / Hessian2Deserializer 上的统计状态，通过 wrap 系列方法包装实例上的方法
+
+    write / read 会递归调用包装后的自身，write_iterative / read_sliced 中容器的开始和结束是两次调用，因此用栈记录每一层子元素占用的字节数和耗时，
+    栈回到最外层时一个消息结束
+    """
+
+    def __init__(self, stats: Hessian2Stats, byte_at: Callable[[int], int], pos: Callable[[], int],
+                 cls_name_before: bool, tables: Callable[[], Tuple[int, int]]):
+        self.stats = stats
+        self.byte_at = byte_at  # 输出或输入中指定位置的字节
+        self.pos = pos
+        self.cls_name_before = cls_name_before
+        self.tables = tables
+        self._stack = [[0, 0.0, None]]  # [子元素的字节数, 子元素的耗时, 写出前得到的 java 类名]
+        self._open: List[tuple] = []  # 已开始未结束的容器
+
+    def _enter(self, v: Any) -> tuple:
+        start_pos = self.pos()
+        cls_name = _class_name_of(v) if self.cls_name_before else None
+        self._stack.append([0, 0.0, cls_name])
+        return start_pos, cls_name, perf_counter()
+
+    def open_classes(self, include_current: bool) -> Tuple[str, ...]:
+        # 正在写出的各层值的 java 类名，由外到内
+        entries = self._stack if include_current else self._stack[:-1]
+        return tuple(str(e[2]) for e in entries if e[2])
+
+    def _leave(self, token: tuple, v: Any, is_value: bool = True) -> None:
+        start_pos, cls_name, start = token
+        elapsed = perf_counter() - start
+        stack = self._stack
+        children = stack.pop()
+        n_bytes = self.pos() - start_pos
+
+        parent = stack[-1]
+        parent[0] += n_bytes
+        parent[1] += elapsed
+        stats = self.stats
+        family = _TAG_FAMILIES[self.byte_at(start_pos)]
+        stats._add(stats.tags, family, n_bytes - children[0], elapsed - children[1])
+        if not self.cls_name_before and family != 'class_def':  # class_def 之后的值由内层调用统计
+            cls_name = _class_name_of(v)
+        if cls_name and family != 'ref':  # ref 不是新的对象
+            stats._add(stats.classes, str(cls_name), n_bytes, elapsed)
+        if len(stack) == 1 and is_value:
+            parent[0] = 0
+            parent[1] = 0.0
+            stats._end_message(*self.tables())
+
+    def wrap(self, method: Callable, is_value: bool = True) -> Callable:
+        # write / read，以及 read_sliced 中 object 之前单独读取的 class 定义（is_value 为 False，不构成消息）
+        def wrapper(*args, **kwargs):
+            token = self._enter(args[0] if args else None)
+            try:
+                v = method(*args, **kwargs)
+            except BaseException:
+                self._stack.pop()
+                raise
+            self._leave(token, v, is_value)
+            return v
+
+        return wrapper
+
+    def wrap_begin(self, method: Callable) -> Callable:
+        # 开始一个容器，返回 None 表示没有子元素需要继续处理（写出为 ref）
+        def wrapper(*args):
+            token = self._enter(args[0])
+            try:
+                frame = method(*args)
+            except BaseException:
+                self._stack.pop()
+                raise
+            if frame is None:
+                self._leave(token, None)
+            else:
+                self._open.append(token)
+            return frame
+
+        return wrapper
+
+    def wrap_end(self, method: Callable) -> Callable:
+        def wrapper(frame: Any) -> Any:
+            token = self._open.pop()
+            try:
+                v = method(frame)
+            except BaseException:
+                self._stack.pop()
+                raise
+            self._leave(token, v)
+            return v
+
+        return wrapper
+
+
 def dumps(v: Any, **kwargs) -> bytes:
     """
     将一个对象按照 hessian 序列化协议转换为字节数组
@@ -93,15 +562,120 @@ def dumps(v: Any, **kwargs) -> bytes:
             'b': '6',
         }]
     }
+    入参不会被修改。dataclass、__slots__ 类和 namedtuple 可以通过 __java_class__ 属性或 register_class 指定 java 类名，直接写出为 object
     """
     # if py3_hessian2_rsimpl:
     #     return py3_hessian2_rsimpl.hessian2_dumps(v)
 
+    serializer = Hessian2Serializer(**kwargs)
+    if kwargs.get('iterative'):
+        serializer.write_iterative(v)
+    else:
+        serializer.write(v)
+    return serializer.export()
+
+
+def dumps_parallel(v: Any, workers: int = None, chunk_size: int = None, **kwargs) -> bytes:
+    """
+    使用多进程序列化一个大 list，输出与 dumps 完全一致
+
+    list 被切分为若干段，每段在子进程中独立序列化为一个片段。片段中的 type 和 ref 并不直接写出，而是记录为占位标记，
+    由主进程按顺序拼接片段时统一编号，因此拼接结果是一个合法的 hessian 消息。
+
+    注意：跨段共享的同一个对象（同一个 id）在子进程中是各自的副本，无法生成 ref，会被重复序列化，反序列化后值相等但不是同一个对象
+
+    支持 dedup、iterative 和 stats 参数。dedup 只在每一段内部合并内容相同的容器；stats 在子进程中统计后合并，整个 list 计为一个消息。
+    cache 无法在子进程之间共享，指定时抛出 TypeError
+    """
+    if kwargs.get('cache'):
+        raise TypeError('dumps_parallel does not support cache')
+    if isinstance(v, (str, bytes)) or not isinstance(v, Sequence):
+        return dumps(v, **kwargs)
+
+    workers = workers or cpu_count() or 1
+    chunk_size = chunk_size or max(1024, -(-len(v) // (workers * 4)))
+    if workers <= 1 or len(v) <= chunk_size:
+        return dumps(v, **kwargs)
+    from concurrent.futures import ProcessPoolExecutor
+
+    stats: Hessian2Stats = kwargs.get('stats')
+    options = {'dedup': kwargs.get('dedup'), 'iterative': kwargs.get('iterative'), 'stats': stats is not None}
+    start = perf_counter()
     serializer = Hessian2Serializer()
-    serializer.write(v)
+    serializer._write_list_header(v)
+    header_bytes, header_seconds = len(serializer._bytes), perf_counter() - start
+    chunks = [list(v[i:i + chunk_size]) for i in range(0, len(v), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for fragment, chunk_stats, mark_classes in executor.map(_encode_fragment, chunks, repeat(options)):
+            if chunk_stats:
+                mark_sizes = []
+                serializer._write_fragment(fragment, mark_sizes)
+                stats._merge(chunk_stats)
+                stats._merge_marks(fragment, mark_sizes, mark_classes)
+            else:
+                serializer._write_fragment(fragment)
+    if stats:
+        stats._add(stats.tags, 'list', header_bytes, header_seconds)
+        cls_name = _class_name_of(v)
+        if cls_name:
+            stats._add(stats.classes, str(cls_name), len(serializer._bytes), perf_counter() - start)
+        stats._end_message(len(serializer._class_definitions), len(serializer._type_names))
     return serializer.export()
 
 
+def dumps_iov(v: Any, **kwargs) -> List[Union[bytes, bytearray, memoryview]]:
+    """
+    与 dumps 相同，但输出为多个 buffer，可以直接交给 socket.sendmsg / os.writev，拼接后与 dumps 的结果一致
+
+    长度不小于 min_view_size（默认 4096）的 binary 不会被复制，直接引用入参中 bytes 对象的 memoryview 切片，在 buffer 使用完之前不能修改这些对象
+    """
+    serializer = _IovSerializer(**kwargs)
+    if kwargs.get('iterative'):
+        serializer.write_iterative(v)
+    else:
+        serializer.write(v)
+    return serializer.export_iov()
+
+
+def dumps_raw(v: Any, **kwargs) -> 'RawHessian':
+    """
+    将对象序列化为可以嵌入其他消息的 RawHessian 片段，片段中的 type、class 定义和 ref 编号在写出时按外层消息重新生成
+
+    常量的子结构（配置、字典数据等）可以只序列化一次，之后每次直接拼接字节。片段的实际字节数在拼接后才能确定，因此不支持 stats 参数
+    """
+    if kwargs.get('stats'):
+        raise TypeError('dumps_raw does not support stats')
+    serializer = _FragmentSerializer(**kwargs)
+    serializer.write(v)
+    return serializer.export_fragment()
+
+
+def raw_from_bytes(data: bytes, **kwargs) -> 'RawHessian':
+    """
+    将一个完整的 hessian 消息（dumps 的结果或 java 侧序列化的数据）转换为 RawHessian 片段，不完整反序列化，只记录其中的 type、class 定义和 ref
+    """
+    rewriter = Hessian2Rewriter(data, out=_FragmentSerializer(), **kwargs)
+    rewriter.rewrite()
+    return rewriter._out.export_fragment()
+
+
+async def loads_async(data: bytes, slice_bytes: int = None, slice_seconds: float = 0.005, **kwargs) -> Any:
+    """
+    与 loads(data, iterative=True) 的结果一致，但每读取 slice_bytes 字节或者耗时 slice_seconds 秒后让出一次事件循环，
+    反序列化大消息时不会长时间阻塞其他任务
+    """
+    import asyncio
+
+    deserializer = Hessian2Deserializer(data, **kwargs)
+    steps = deserializer.read_sliced(slice_bytes, slice_seconds)
+    try:
+        while True:
+            next(steps)
+            await asyncio.sleep(0)
+    except StopIteration as e:
+        return e.value
+
+
 def loads(data: bytes, **kwargs) -> Any:
     """
     将字节数组按照 hessian 序列化协议转换为对象
@@ -125,19 +699,185 @@ def loads(data: bytes, **kwargs) -> Any:
     # if py3_hessian2_rsimpl:
     #     return py3_hessian2_rsimpl.hessian2_loads(data)
 
-    return Hessian2Deserializer(data).read()
+    deserializer = Hessian2Deserializer(data, **kwargs)
+    if kwargs.get('iterative'):
+        return deserializer.read_iterative()
+    return deserializer.read()
+
+
+def loads_tracked(data: bytes, **kwargs) -> 'Hessian2Message':
+    """
+    反序列化并记录每个容器在原始字节中的位置，修改结果后通过 Hessian2Message.dumps 重新序列化时，未修改的部分直接复制原始字节
+    """
+    return Hessian2Message(data, **kwargs)
+
+
+def transcode_json(data: bytes, out: Any = None, **kwargs) -> Optional[str]:
+    """
+    将 hessian 字节数组直接转换为 json 文本，不构建中间的 python 对象。指定 out（有 write 方法的文本流）时写入 out，否则返回字符串
+
+    可选参数：
+        binary: 'base64'（默认）或 'hex'
+        date_format: 'iso'（默认，UTC 时间的 ISO 8601 字符串）或 'millis'（epoch 毫秒数）
+        class_key: object 和带类型的 map 输出类名时使用的 key，默认 '#class'，为 None 时不输出类名
+        refs: 'marker'（默认，输出 {"$ref": n}）、'copy'（重新输出被引用的值，循环引用仍输出 marker）或 'null'
+        ensure_ascii: 是否将非 ascii 字符转义，默认 False
+    """
+    if out is not None:
+        Hessian2JsonTranscoder(data, out, **kwargs).transcode()
+        return None
+    from io import StringIO
+
+    buf = StringIO()
+    Hessian2JsonTranscoder(data, buf, **kwargs).transcode()
+    return buf.getvalue()
+
+
+@dataclass(frozen=True)
+class Projection:
+    """
+    project 的裁剪规则
+
+    路径是从根开始、以 . 分隔的字段名（map 的 key 或 object 的字段），list 的元素不占用路径层级，* 匹配任意字段名
+    """
+    drop_paths: Collection[str] = ()  # 删除这些路径上的字段
+    keep_paths: Optional[Collection[str]] = None  # 指定时只保留这些路径上的字段（包括其祖先和子孙）
+    drop_fields: Dict[str, Collection[str]] = None  # java 类名 -> 该类的 object / 带类型的 map 中需要删除的字段
+    drop_classes: Collection[str] = ()  # 这些类的 object / 带类型的 map 整体替换为 null
+
+
+def project(data: bytes, projection: Projection, **kwargs) -> bytes:
+    """
+    按 projection 裁剪 hessian 字节数组，不完整反序列化，未改动的值按原始字节复制
+
+    被删除的字段中定义的 type / class 会在后面第一次使用时重新定义，ref 编号重新计算，被删除的容器在保留的位置再次被引用时重新输出，
+    指向被 drop_classes 删除的对象的 ref 替换为 null
+    """
+    rewriter = Hessian2Rewriter(data, projection, **kwargs)
+    rewriter.rewrite()
+    return rewriter.export()
+
+
+_MARK_TYPE = 0
+_MARK_REF = 1
+_MARK_CLASS = 2
+
+
+def inspect_payload(data: bytes, top: int = 20, **kwargs) -> dict:
+    """
+    分析 hessian 字节数组（可以是多个消息直接拼接）中字节的分布，返回可以直接转换为 json 的结果：
+      - tags: 按 tag 类型统计的个数和字节数
+      - classes: 按 java 类统计的个数、字节数（含子元素）、class 定义次数，以及每个字段的值占用的字节数
+      - strings: 字符串总数、字节数，以及重复浪费字节数最多的 top 个字符串
+      - refs: ref 个数，以及所有容器中通过 ref 写出的比例
+      - class_definitions: class 定义个数，以及平均每个定义被多少个 object 使用
+      - savings: 带类型的 map 改为 object 编码、重复的字符串改为引用，估计可以节省的字节数
+    """
+    stats = Hessian2Stats()
+    inspector = Hessian2Inspector(data, stats=stats, **kwargs)
+    inspector.inspect()
+    return inspector.report(stats.snapshot(), top)
+
+
+@dataclass(frozen=True)
+class RawHessian:
+    """
+    预先序列化的片段，Hessian2Serializer.write 遇到时直接复制字节
+
+    type、class 定义和 ref 依赖外层消息的编号，因此不写入 data，而是在 marks 中声明，写出时按外层消息的编号重新生成：
+      - (offset, _MARK_TYPE, type_name)
+      - (offset, _MARK_REF, 片段内的 ref 编号)
+      - (offset, _MARK_CLASS, (class_name, field_names))，生成 object 的头部，class 定义在外层消息中第一次使用时写出
+    ref_count 是片段中 map / list / object 的数量，反序列化时它们会占用 ref 编号
+
+    一般通过 dumps_raw / raw_from_bytes 生成。直接使用 RawHessian(data) 时 data 原样写出，只能包含不涉及上述编号的值（字符串、数字、binary 等）
+    """
+    data: bytes
+    marks: Tuple[Tuple[int, int, Any], ...] = ()  # 按 offset 有序
+    ref_count: int = 0
+
+
+# 本模块自己的 dataclass 不是 java 对象，_class_plan 不为它们生成写出方式
+_INTERNAL_DATACLASSES = (_ClassPlan, Hessian2Limits, Projection, RawHessian)
+
+
+class Hessian2FragmentCache:
+    """
+    序列化结果的 LRU 缓存，通过 dumps / Hessian2Serializer 的 cache 参数指定，可以在多次序列化之间共享，线程安全
+
+    缓存 tuple（按对象 id，缓存项持有该对象，因此 id 不会被复用）和长度不小于 min_string_length 的字符串（按值），
+    调用方需要保证 tuple 及其中的容器不会被修改，tuple 中的对象与外层消息共享时不会生成 ref
+    """
+
+    def __init__(self, maxsize: int = 256, min_string_length: int = 1024):
+        self.maxsize = maxsize
+        self.min_string_length = min_string_length
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()  # key -> (对象, RawHessian)
+        self._lock = Lock()
+
+    def get(self, v: Union[tuple, str]) -> RawHessian:
+        key = v if isinstance(v, str) else id(v)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        fragment = dumps_raw(v)
+        with self._lock:
+            self._entries[key] = (v, fragment)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return fragment
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
 
 
 class Hessian2Serializer:
     def __init__(self, **kwargs):
         self._bytes: bytearray = bytearray()
         self._refs: Dict[int, int] = {}  # key 是对象 id
-        self._class_definitions: Dict[str, int] = {}
+        self._ref_count = 0  # 已分配的 ref 编号数量，拼接片段时会占用编号但不会进入 _refs
+        self._class_definitions: Dict[Tuple[str, Tuple[str, ...]], int] = {}  # key 是 (类名, 字段名)
         self._type_names: Dict[str, int] = {}
+        self._cache_types: tuple = ()  # write_iterative 中需要交给 write 处理的容器类型
+
+        if kwargs.get('dedup'):
+            # 内容相同的容器也写出为 ref，反序列化后会成为同一个对象，只适用于不会被修改的数据
+            self._content_keys: Dict[int, int] = {}  # 对象 id -> 内容编号
+            self._content_shapes: Dict[tuple, int] = {}  # 内容 -> 内容编号
+            self._content_refs: Dict[int, int] = {}  # 内容编号 -> ref 编号
+            self._try_write_ref = self._try_write_ref_dedup
+
+        cache: Hessian2FragmentCache = kwargs.get('cache')
+        if cache:
+            self._cache = cache
+            self._cache_types = (tuple,)
+            self.write = self._write_cached
+
+        stats: Hessian2Stats = kwargs.get('stats')
+        if stats:
+            probe = self._stats_probe = stats._probe(self._byte_at, self._output_pos, True,
+                                                     lambda: (len(self._class_definitions), len(self._type_names)))
+            self.write = probe.wrap(self.write)
+            self._begin_write_frame = probe.wrap_begin(self._begin_write_frame)
+            self._end_write_frame = probe.wrap_end(self._end_write_frame)
 
     def export(self) -> bytes:
         return bytes(self._bytes)
 
+    def _output_pos(self) -> int:
+        return len(self._bytes)
+
+    def _byte_at(self, pos: int) -> int:
+        return self._bytes[pos]
+
     def write(self, v: Any) -> None:
         if v is None:
             self.write_null()
@@ -154,12 +894,67 @@ class Hessian2Serializer:
         elif isinstance(v, datetime):
             self.write_datetime(v)
         elif isinstance(v, Sequence):
-            self.write_list(v)
+            if isinstance(v, tuple) and type(v) is not tuple and _class_plan(type(v)):
+                self.write_object(v)  # 指定了 java 类名的 namedtuple
+            else:
+                self.write_list(v)
         elif isinstance(v, dict):
             self.write_map(v)
+        elif isinstance(v, RawHessian):
+            self._write_fragment(v)
+        elif isinstance(v, Hessian2Record):
+            self.write_record(v)
+        elif _class_plan(type(v)):
+            self.write_object(v)
         else:
             raise ValueError('unsupported type: %s' % type(v))
 
+    def _write_cached(self, v: Any) -> None:
+        if type(v) is tuple:
+            self._write_fragment(self._cache.get(v))
+        elif type(v) is str and len(v) >= self._cache.min_string_length:
+            self._write_fragment(self._cache.get(v))
+        else:
+            Hessian2Serializer.write(self, v)
+
+    def write_iterative(self, v: Any) -> None:
+        # 与 write 的输出完全一致，但使用显式栈代替递归，嵌套深度不受 python 递归深度限制
+        stack = [(iter((v,)), False)]  # (未写出的子元素, 是否需要写出 map 结束符)
+        while stack:
+            children, is_map = stack[-1]
+            for e in children:
+                plan = None if type(e) is list or type(e) is dict else _class_plan(type(e))
+                if not plan and (isinstance(e, (str, bytes)) or not isinstance(e, (Sequence, dict, Hessian2Record))
+                                 or isinstance(e, self._cache_types)):
+                    self.write(e)
+                    continue
+                frame = self._begin_write_frame(e, plan)
+                if frame is not None:
+                    stack.append(frame)
+                break
+            else:
+                frame = stack.pop()
+                if stack:
+                    self._end_write_frame(frame)
+
+    def _begin_write_frame(self, v: Any, plan: Optional[_ClassPlan]) -> Optional[tuple]:
+        # write_iterative 中写出容器的头部，返回 (未写出的子元素, 是否需要写出 map 结束符)，写出为 ref 时返回 None
+        if plan:
+            return self._object_children(v, plan) if self._write_object_header_of(v, plan) else None
+        if isinstance(v, Sequence):
+            return (iter(v), False) if self._write_list_header(v) else None
+        if isinstance(v, Hessian2Record):
+            return (map(v.__getitem__, v._field_names), False) if self._write_record_header(v) else None
+        if not self._write_map_header(v):
+            return None
+        # #class 只作为类型写出，逐个跳过而不复制入参
+        items = filter(lambda item: item[0] != '#class', v.items()) if '#class' in v else v.items()
+        return chain.from_iterable(items), True
+
+    def _end_write_frame(self, frame: tuple) -> None:
+        if frame[1]:
+            self._bytes.append(0x5a)
+
     def write_null(self) -> None:
         # null ::= 'N'
         self._bytes.append(0x4e)  # 'N'
@@ -237,8 +1032,8 @@ class Hessian2Serializer:
 
         l = self._calc_string_length(v)  # 按字符计算，而不是按字节
 
-        if l <= 32:
-            # utf-8 string length 0-32
+        if l <= 31:
+            # utf-8 string length 0-31
             self._bytes.append(0x00 + l)
             self._write_utf8_bytes(v)
         elif l <= 1023:
@@ -249,11 +1044,11 @@ class Hessian2Serializer:
         else:
             # utf-8 string split into 64K chunks
             # FIXME: 字符串中存在扩展平面的字符时，直接按 65536 来 split 会出错
-            chunks = [v[i:i + 65535] for i in range(0, l, 65535)]
+            chunks = [v[i:i + 65535] for i in range(0, len(v), 65535)]
             for idx, chunk in enumerate(chunks):
                 is_last_chunk = idx == len(chunks) - 1
                 self._bytes.extend(pack('>cH', b'S' if is_last_chunk else b'R', len(chunk)))  # 'R' for non-final chunk, 'S' for final chunk
-                self._write_utf8_bytes(v)
+                self._write_utf8_bytes(chunk)
 
     @staticmethod
     def _calc_string_length(s: str) -> int:
@@ -261,10 +1056,13 @@ class Hessian2Serializer:
         return int((len(s.encode('utf-16')) - 2) / 2)
 
     def _write_utf8_bytes(self, s: str) -> None:
+        self._bytes.extend(self._encode_utf8(s))
+
+    def _encode_utf8(self, s: str) -> Union[bytes, bytearray]:
         simple = len(s) == self._calc_string_length(s)
 
         if simple:
-            self._bytes.extend(s.encode())
+            return s.encode()
         else:
             # 不能简单使用 encode()，hessian2 的 java 实现未正确处理 UTF-8 补充平面（4字节）情况，而是使用两个 char 强行拼接，python 实现必须兼容此情况，虽然与 unicode 规范不一致
             buf = bytearray()
@@ -287,7 +1085,7 @@ class Hessian2Serializer:
                         (0x80 | ((low_surrogate >> 6) & 0x3F)),
                         (0x80 | (low_surrogate & 0x3F))
                     ])
-            self._bytes.extend(buf)
+            return buf
 
     def write_bytes(self, v: bytes) -> None:
         # binary ::= 'A; b1 b0 <binary-data>  # non-final chunk
@@ -302,31 +1100,33 @@ class Hessian2Serializer:
             return
 
         # 将字节数组按 4093 拆分为 chunks，至于为什么是 4093 是为了和 java 实现保持一致
-        chunks = [v[i:i + 4093] for i in range(0, len(v), 4093)]
-        for idx, chunk in enumerate(chunks):
-            is_last_chunk = idx == len(chunks) - 1
-
-            l = len(chunk)
-            if l <= 15:
-                # binary length 0-16
-                self._bytes.append(0x20 + l)
-                self._bytes.extend(chunk)
-            elif l <= 1023:
-                # binary length 0-1023
-                self._bytes.append(0x34 + (l >> 8))
-                self._bytes.append(l & 0xff)
-                self._bytes.extend(chunk)
-            else:
-                # chunk
-                self._bytes.extend(pack('>cH', b'B' if is_last_chunk else b'A', l))  # 'A' for non-final chunk, 'B' for final chunk
-                self._bytes.extend(chunk)
+        view = memoryview(v)
+        for i in range(0, len(v), 4093):
+            chunk = view[i:i + 4093]
+            self._write_binary_chunk_header(len(chunk), i + 4093 >= len(v))
+            self._bytes.extend(chunk)
+
+    def _write_binary_chunk_header(self, l: int, is_last_chunk: bool) -> None:
+        if l <= 15:
+            # binary length 0-16
+            self._bytes.append(0x20 + l)
+        elif l <= 1023:
+            # binary length 0-1023
+            self._bytes.append(0x34 + (l >> 8))
+            self._bytes.append(l & 0xff)
+        else:
+            # chunk
+            self._bytes.extend(pack('>cH', b'B' if is_last_chunk else b'A', l))  # 'A' for non-final chunk, 'B' for final chunk
 
     def write_datetime(self, v: datetime) -> None:
         # date ::= x4a b7 b6 b5 b4 b3 b2 b1 b0
         #      ::= x4b b3 b2 b1 b0       # minutes since epoch
-        # only support 64-bit timestamp
         ts = int(v.timestamp() * 1000)
-        self._bytes.extend(pack('>cq', b'J', ts))
+        if ts % 60000 == 0 and -0x80000000 <= ts // 60000 <= 0x7fffffff:
+            # 整分钟的时间使用 32-bit 的分钟数表示
+            self._bytes.extend(pack('>cl', b'K', ts // 60000))
+        else:
+            self._bytes.extend(pack('>cq', b'J', ts))
 
     def write_list(self, v: Sequence[Any]) -> None:
         # list ::= x55 type value* 'Z'   # variable-length list
@@ -335,6 +1135,16 @@ class Hessian2Serializer:
         #      ::= x58 int value*        # fixed-length untyped list
         #      ::= [x70-77] type value*  # fixed-length typed list
         #      ::= [x78-7f] value*       # fixed-length untyped list
+        if not self._write_list_header(v):
+            return
+        for e in v:
+            self.write(e)
+
+    def _write_list_header(self, v: Sequence[Any]) -> bool:
+        # 返回 False 表示写出的是 ref，不需要再写出 list 的内容
+        if self._try_write_ref(v):
+            return False
+
         l = len(v)
         cls_name = str(v.__dict__['#class']) if hasattr(v, '__dict__') and '#class' in v.__dict__ else None
 
@@ -351,8 +1161,7 @@ class Hessian2Serializer:
             else:
                 self._bytes.append(0x58)
             self.write_int(l)
-        for e in v:
-            self.write(e)
+        return True
 
     def write_map(self, o: dict) -> None:
         # map ::= 'M' type (value value)* 'Z'  # key, value map pairs
@@ -360,10 +1169,23 @@ class Hessian2Serializer:
         if o is None:
             self.write_null()
             return
-        if self._try_write_ref(o):
+        if not self._write_map_header(o):
             return
 
-        cls_name = o.pop('#class', None)
+        has_cls_name = '#class' in o
+        for k, v in o.items():
+            if has_cls_name and k == '#class':
+                continue  # #class 只作为类型写出，不修改入参
+            self.write(k)
+            self.write(v)
+        self._bytes.append(0x5a)
+
+    def _write_map_header(self, o: dict) -> bool:
+        # 返回 False 表示写出的是 ref，不需要再写出 map 的内容
+        if self._try_write_ref(o):
+            return False
+
+        cls_name = o.get('#class')
         if cls_name:
             # 如果指定了 #class 则使用 M 协议，表示是一个 object
             self._bytes.append(0x4d)
@@ -371,11 +1193,52 @@ class Hessian2Serializer:
         else:
             # 如果未指定 #class 则使用 H 协议，对应 java.util.HashMap
             self._bytes.append(0x48)
+        return True
 
-        for k, v in o.items():
-            self.write(k)
-            self.write(v)
-        self._bytes.append(0x5a)
+    def write_object(self, v: Any) -> None:
+        # dataclass、__slots__ 类、namedtuple 按缓存的字段表写出为 object，未指定 java 类名的 dataclass 写出为不带类型的 map
+        plan = _class_plan(type(v))
+        if not self._write_object_header_of(v, plan):
+            return
+        if plan.java_class:
+            for e in plan.values(v):
+                self.write(e)
+        else:
+            for k, e in zip(plan.field_names, plan.values(v)):
+                self.write_string(k)
+                self.write(e)
+            self._bytes.append(0x5a)
+
+    def _write_object_header_of(self, v: Any, plan: _ClassPlan) -> bool:
+        # 返回 False 表示写出的是 ref
+        if self._try_write_ref(v):
+            return False
+        if plan.java_class:
+            self._write_object_header(plan.java_class, plan.field_names)
+        else:
+            self._bytes.append(0x48)
+        return True
+
+    @staticmethod
+    def _object_children(v: Any, plan: _ClassPlan) -> Tuple[Any, bool]:
+        # write_iterative 中的 (未写出的子元素, 是否需要写出 map 结束符)
+        if plan.java_class:
+            return iter(plan.values(v)), False
+        return chain.from_iterable(zip(plan.field_names, plan.values(v))), True
+
+    def write_record(self, v: Hessian2Record) -> None:
+        # 按原始的 class 定义写出为 object
+        if not self._write_record_header(v):
+            return
+        for field_name in v._field_names:
+            self.write(v[field_name])
+
+    def _write_record_header(self, v: Hessian2Record) -> bool:
+        # 返回 False 表示写出的是 ref
+        if self._try_write_ref(v):
+            return False
+        self._write_object_header(v._cls_name, v._field_names)
+        return True
 
     def _write_type(self, type_name: str) -> None:
         # type ::= string
@@ -391,13 +1254,228 @@ class Hessian2Serializer:
         # ref ::= x51 int  # reference to nth map/list/object
         idx = self._refs.get(id(o), -1)
         if idx == -1:
-            self._refs[id(o)] = len(self._refs)
+            if not isinstance(o, tuple):
+                # tuple 不可变，是否为同一个对象对调用方没有意义，() 和编译器共享的常量 tuple 也不应该被合并。内容相同时由 dedup 合并
+                self._refs[id(o)] = self._ref_count
+            self._ref_count += 1
             return False
         else:
-            self._bytes.append(0x51)
-            self.write_int(idx)
+            self._write_ref(idx)
             return True
 
+    def _try_write_ref_dedup(self, o: Any) -> bool:
+        idx = self._refs.get(id(o), -1)
+        if idx == -1:
+            key = self._content_key(o)
+            idx = self._content_refs.get(key, -1)
+            if idx == -1:
+                self._refs[id(o)] = self._content_refs[key] = self._ref_count
+                self._ref_count += 1
+                return False
+            self._refs[id(o)] = idx
+        self._write_ref(idx)
+        return True
+
+    def _content_key(self, o: Any) -> int:
+        # 按内容给容器编号，内容相同的容器编号相同。使用显式栈后序遍历，子容器的编号会被缓存
+        keys = self._content_keys
+        key = keys.get(id(o))
+        if key is not None:
+            return key
+
+        pending = set()  # 正在计算的容器，再次遇到说明存在循环引用
+        stack = [(o, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if id(node) in keys:
+                continue
+            plan = _class_plan(type(node))
+            if plan:
+                children = plan.values(node)
+            else:
+                children = chain.from_iterable(node.items()) if isinstance(node, (dict, Hessian2Record)) else node
+            if not children_done:
+                pending.add(id(node))
+                stack.append((node, True))
+                stack.extend((c, False) for c in children if self._is_container(c) and id(c) not in keys and id(c) not in pending)
+                continue
+            shape = (type(node), _class_name_of(node), tuple(
+                # 循环引用的容器无法按内容比较，使用其 id 保证不会被合并
+                (keys[id(c)] if id(c) in keys else ('cycle', id(c))) if self._is_container(c) else (type(c), c)
+                for c in children))
+            keys[id(node)] = self._content_shapes.setdefault(shape, len(self._content_shapes))
+            pending.discard(id(node))
+        return keys[id(o)]
+
+    @staticmethod
+    def _is_container(v: Any) -> bool:
+        return isinstance(v, (dict, Hessian2Record)) or (isinstance(v, Sequence) and not isinstance(v, (str, bytes))) or _class_plan(type(v)) is not None
+
+    def _write_ref(self, idx: int) -> None:
+        self._bytes.append(0x51)
+        self.write_int(idx)
+
+    def _write_object_header(self, cls_name: str, field_names: Tuple[str, ...]) -> None:
+        # object ::= 'O' int value*
+        #        ::= [x60-x6f] value*
+        cls_idx = self._class_definitions.get((cls_name, field_names), -1)
+        if cls_idx == -1:
+            # class_def ::= 'C' string int string*
+            cls_idx = len(self._class_definitions)
+            self._class_definitions[(cls_name, field_names)] = cls_idx
+            self._bytes.append(0x43)
+            self.write_string(cls_name)
+            self.write_int(len(field_names))
+            for name in field_names:
+                self.write_string(name)
+        if cls_idx < 16:
+            self._bytes.append(0x60 + cls_idx)
+        else:
+            self._bytes.append(0x4f)
+            self.write_int(cls_idx)
+
+    def _write_fragment(self, fragment: RawHessian, mark_sizes: List[Tuple[int, bool]] = None) -> None:
+        # 拼接一个独立序列化的片段，片段中的 type、class 和 ref 占位标记按当前的编号重新生成
+        # 指定 mark_sizes 时记录每个标记实际写出的字节数，以及是否写出了新的 class 定义，供 dumps_parallel 修正统计
+        data = memoryview(fragment.data)
+        ref_base = self._ref_count
+        pos = 0
+        for offset, kind, value in fragment.marks:
+            self._write_raw(data[pos:offset])
+            start, class_definitions = len(self._bytes), len(self._class_definitions)
+            if kind == _MARK_TYPE:
+                self._write_type(value)
+            elif kind == _MARK_REF:
+                self._write_ref(ref_base + value)
+            else:
+                self._write_object_header(*value)
+            if mark_sizes is not None:
+                mark_sizes.append((len(self._bytes) - start, len(self._class_definitions) > class_definitions))
+            pos = offset
+        self._write_raw(data[pos:])
+        self._ref_count += fragment.ref_count
+
+    def _write_raw(self, data: memoryview) -> None:
+        self._bytes.extend(data)
+
+
+class _FragmentSerializer(Hessian2Serializer):
+    """
+    序列化出的字节不依赖外部的 type 表、class 表和 ref 编号，只记录占位标记，由 Hessian2Serializer._write_fragment 拼接时生成
+
+    dumps_parallel 的子进程中指定 stats 时，每个标记在统计中按 1 字节计，位置依次排在该 offset 的字节之前，ref 和 object 头部按各自的 tag 统计。
+    同时记录每个标记所在的各层 java 类名，由主进程按实际写出的字节数修正
+    """
+
+    def __init__(self, **kwargs):
+        self._marks: List[Tuple[int, int, Any]] = []
+        self._mark_positions: List[int] = []  # 每个标记在统计中的位置
+        self._mark_classes: List[Tuple[str, ...]] = []
+        self._stats_probe: Optional[_StatsProbe] = None
+        super().__init__(**kwargs)
+
+    def export_fragment(self) -> RawHessian:
+        return RawHessian(bytes(self._bytes), tuple(self._marks), self._ref_count)
+
+    def _output_pos(self) -> int:
+        return len(self._bytes) + len(self._marks)
+
+    def _byte_at(self, pos: int) -> int:
+        i = bisect_left(self._mark_positions, pos)
+        if i < len(self._mark_positions) and self._mark_positions[i] == pos:
+            return 0x51 if self._marks[i][1] == _MARK_REF else 0x60  # 值的开头只可能是 ref 或 object 头部
+        return self._bytes[pos - i]
+
+    def _add_mark(self, kind: int, value: Any) -> None:
+        if self._stats_probe:
+            self._mark_positions.append(len(self._bytes) + len(self._marks))
+            self._mark_classes.append(self._stats_probe.open_classes(kind != _MARK_REF))  # ref 不是新的对象，不计入自身的类
+        self._marks.append((len(self._bytes), kind, value))
+
+    def _write_type(self, type_name: str) -> None:
+        self._add_mark(_MARK_TYPE, type_name)
+
+    def _write_ref(self, idx: int) -> None:
+        self._add_mark(_MARK_REF, idx)
+
+    def _write_object_header(self, cls_name: str, field_names: Tuple[str, ...]) -> None:
+        self._add_mark(_MARK_CLASS, (cls_name, field_names))
+
+
+class _IovSerializer(Hessian2Serializer):
+    """
+    输出为多个 buffer，较小的 tag 和值写入共享的 bytearray，较大的 binary 直接引用调用方对象的 memoryview 切片，较大的字符串编码后作为单独的 buffer，
+    都不会复制到 bytearray 中
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._buffers: List[Union[bytes, bytearray, memoryview]] = []
+        self._buffer_offsets: List[int] = []  # 每个 buffer 在输出中的起始位置
+        self._flushed = 0  # _buffers 的总长度
+        self._min_view_size: int = kwargs.get('min_view_size', 4096)
+
+    def export_iov(self) -> List[Union[bytes, bytearray, memoryview]]:
+        self._flush()
+        return self._buffers
+
+    def _flush(self) -> None:
+        if self._bytes:
+            self._add_buffer(self._bytes)
+            self._bytes = bytearray()
+
+    def _append_buffer(self, buffer: Union[bytes, bytearray, memoryview]) -> None:
+        self._flush()
+        self._add_buffer(buffer)
+
+    def _add_buffer(self, buffer: Union[bytes, bytearray, memoryview]) -> None:
+        self._buffers.append(buffer)
+        self._buffer_offsets.append(self._flushed)
+        self._flushed += len(buffer)
+
+    def _output_pos(self) -> int:
+        return self._flushed + len(self._bytes)
+
+    def _byte_at(self, pos: int) -> int:
+        if pos >= self._flushed:
+            return self._bytes[pos - self._flushed]
+        i = bisect_right(self._buffer_offsets, pos) - 1
+        return self._buffers[i][pos - self._buffer_offsets[i]]
+
+    def write_bytes(self, v: bytes) -> None:
+        if v is None or len(v) < self._min_view_size:
+            super().write_bytes(v)
+            return
+
+        view = memoryview(v)
+        for i in range(0, len(v), 4093):
+            chunk = view[i:i + 4093]
+            self._write_binary_chunk_header(len(chunk), i + 4093 >= len(v))
+            self._append_buffer(chunk)
+
+    def _write_utf8_bytes(self, s: str) -> None:
+        if len(s) < self._min_view_size:
+            super()._write_utf8_bytes(s)
+        else:
+            self._append_buffer(self._encode_utf8(s))
+
+    def _write_raw(self, data: memoryview) -> None:
+        # RawHessian 的 data 是不可变的 bytes，可以直接引用
+        if len(data) < self._min_view_size:
+            super()._write_raw(data)
+        else:
+            self._append_buffer(data)
+
+
+def _encode_fragment(values: list, options: dict) -> Tuple[RawHessian, Optional[Hessian2Stats], List[Tuple[str, ...]]]:
+    # 在子进程中执行，因此必须是模块级函数。stats 在子进程中单独统计，由主进程合并并按标记的实际字节数修正
+    stats = Hessian2Stats() if options['stats'] else None
+    serializer = _FragmentSerializer(dedup=options['dedup'], stats=stats)
+    write = serializer.write_iterative if options['iterative'] else serializer.write
+    for v in values:
+        write(v)
+    return serializer.export_fragment(), stats, serializer._mark_classes
+
 
 class Hessian2Deserializer:
     class _ByteReader:
@@ -424,6 +1502,9 @@ class Hessian2Deserializer:
         def pos(self) -> int:
             return self._pos
 
+        def seek(self, pos: int) -> None:
+            self._pos = pos
+
         def raw_data_unsafe(self) -> bytes:
             return self._data
 
@@ -438,6 +1519,160 @@ class Hessian2Deserializer:
         self._refs: List[Any] = []
         self._cls_definitions: List[Hessian2Deserializer._ClsDefinition] = []
         self._type_names: List[str] = []
+        self._date_converter = _DATE_CONVERTERS[kwargs.get('dates') or DateMode.DATETIME]
+
+        self._binary_sink: Callable[[], Any] = kwargs.get('binary_sink')
+        if self._binary_sink:
+            # 超过阈值的 binary 不再读入内存，而是写入 binary_sink() 返回的对象（需要有 write 方法），值为该对象本身
+            self._binary_sink_threshold: int = kwargs.get('binary_sink_threshold', 1 << 20)
+            self.read_bytes = self._read_bytes_to_sink
+
+        if kwargs.get('records'):
+            self._record_types: Dict[int, type] = {}  # class 定义编号 -> Hessian2Record 子类
+            self._read_object_header = self._read_record_header
+
+        limits: Hessian2Limits = kwargs.get('limits')
+        if limits:
+            self._install_limits(limits)
+
+        stats: Hessian2Stats = kwargs.get('stats')
+        if stats:
+            probe = stats._probe(self._reader.raw_data_unsafe().__getitem__, self._reader.pos, False,
+                                 lambda: (len(self._cls_definitions), len(self._type_names)))
+            self.read = probe.wrap(self.read)
+            self._begin_frame = probe.wrap_begin(self._begin_frame)
+            self._finish_frame = probe.wrap_end(self._finish_frame)
+            self._read_leading_class_def = probe.wrap(self._read_leading_class_def, False)
+
+    def _install_limits(self, limits: Hessian2Limits) -> None:
+        # 与 stats 一样通过替换实例上的方法实现，未指定 limits 时没有额外开销
+        depth = 0
+        counts: List[Optional[list]] = []  # 递归读取的容器各自已读的元素个数，[count, is_map]，读取类型名期间为 None
+        frame_counts: List[list] = []  # read_sliced 中每个 frame 已读的元素个数
+        string_chars = 0
+        binary_length = 0
+        total_bytes = 0
+
+        def check(name: str, value: int, limit: Optional[int]) -> None:
+            if limit is not None and value > limit:
+                raise Hessian2LimitError(f'{name} {value} exceeds limit {limit} at {self._reader.pos()}')
+
+        def container(method: Callable, pairs: bool = False) -> Callable:
+            def wrapper(*args):
+                nonlocal depth
+                depth += 1
+                check('depth', depth, limits.max_depth)
+                counts.append([0, pairs])
+                try:
+                    return method(*args)
+                finally:
+                    depth -= 1
+                    counts.pop()
+            return wrapper
+
+        def count(counter: list) -> None:
+            # 每读一个元素计数一次，map 的 key 和 value 各计一次，超过限制时立即报错，不必等整个容器读完
+            counter[0] += 1
+            check('container length', (counter[0] + 1) >> 1 if counter[1] else counter[0], limits.max_container_length)
+
+        def read(**kwargs) -> Any:
+            counter = counts[-1] if counts else None
+            if counter is not None and self._reader.look_byte() != 0x43:  # class_def 之后的值由内层的 read 计数
+                count(counter)
+            return read_method(**kwargs)
+
+        def read_type() -> str:
+            counts.append(None)  # 类型名同样通过 read 读取，但不是容器的元素
+            try:
+                return read_type_method()
+            finally:
+                counts.pop()
+
+        def begin_frame(family: str) -> list:
+            nonlocal depth
+            depth += 1
+            check('depth', depth, limits.max_depth)
+            frame_counts.append([0, family == 'map'])
+            return begin_frame_method(family)
+
+        def add_to_frame(frame: list, v: Any) -> bool:
+            count(frame_counts[-1])
+            return add_to_frame_method(frame, v)
+
+        def finish_frame(frame: list) -> Any:
+            nonlocal depth
+            depth -= 1
+            frame_counts.pop()
+            return finish_frame_method(frame)
+
+        def read_list_header() -> Tuple[int, Optional[str]]:
+            length, cls_name = read_list_header_method()
+            check('list length', length, limits.max_container_length)
+            return length, cls_name
+
+        def read_string() -> str:
+            nonlocal string_chars
+            string_chars = 0
+            return read_string_method()
+
+        def read_utf8_bytes(n_chars: int) -> bytes:
+            nonlocal string_chars, total_bytes
+            string_chars += n_chars
+            check('string length', string_chars, limits.max_string_length)
+            v = read_utf8_bytes_method(n_chars)
+            total_bytes += len(v)
+            check('total bytes', total_bytes, limits.max_total_bytes)
+            return v
+
+        def read_bytes() -> Any:
+            nonlocal binary_length, total_bytes
+            binary_length = 0
+            v = read_bytes_method()
+            if isinstance(v, (bytes, bytearray)) and binary_length != len(v):
+                # binary_sink 模式下未超过阈值的 chunk 直接读入内存，读完后再检查，内存占用不超过阈值。写入 binary_sink 的值不占用内存
+                check('binary length', len(v), limits.max_binary_length)
+                total_bytes += len(v)
+                check('total bytes', total_bytes, limits.max_total_bytes)
+            return v
+
+        def read_binary_chunk(length: int) -> bytes:
+            nonlocal binary_length, total_bytes
+            binary_length += length
+            check('binary length', binary_length, limits.max_binary_length)
+            total_bytes += length
+            check('total bytes', total_bytes, limits.max_total_bytes)
+            return read_binary_chunk_method(length)
+
+        def table(method: Callable, name: str, get_table: Callable[[], list], limit: Optional[int]) -> Callable:
+            def wrapper(*args):
+                v = method(*args)
+                check(name, len(get_table()), limit)
+                return v
+            return wrapper
+
+        read_method, begin_frame_method = self.read, self._begin_frame
+        add_to_frame_method, finish_frame_method = self._add_to_frame, self._finish_frame
+        read_list_header_method, read_string_method = self._read_list_header, self.read_string
+        read_utf8_bytes_method, read_bytes_method = self._read_utf8_bytes, self.read_bytes
+        read_binary_chunk_method, read_type_method = self._read_binary_chunk, self.read_type
+
+        self.read = read
+        self.read_list = container(self.read_list)
+        self.read_map = container(self.read_map, True)
+        self.read_object = container(self.read_object)
+        self._begin_frame = begin_frame
+        self._add_to_frame = add_to_frame
+        self._finish_frame = finish_frame
+        self._read_list_header = read_list_header
+        self.read_string = read_string
+        self._read_utf8_bytes = read_utf8_bytes
+        self.read_bytes = read_bytes
+        self._read_binary_chunk = read_binary_chunk
+        self._new_list = table(self._new_list, 'refs', lambda: self._refs, limits.max_refs)
+        self._read_map_header = table(self._read_map_header, 'refs', lambda: self._refs, limits.max_refs)
+        self._read_object_header = table(self._read_object_header, 'refs', lambda: self._refs, limits.max_refs)
+        self.read_class_def = table(self.read_class_def, 'class definitions', lambda: self._cls_definitions, limits.max_class_definitions)
+        self.read_type = table(read_type, 'type names', lambda: self._type_names, limits.max_type_names)
 
     def read(self, **kwargs) -> Any:
         b = self._reader.look_byte()
@@ -511,6 +1746,119 @@ class Hessian2Deserializer:
         else:
             raise ValueError(f'token error {b}')
 
+    # read_iterative 中未读完的容器，[kind, container, ...]
+    _FRAME_VARIABLE_LIST = 0  # [kind, list]
+    _FRAME_MAP = 1  # [kind, dict, key, has_key]
+    _FRAME_FIXED_LIST = 2  # [kind, list, length, idx]
+    _FRAME_OBJECT = 3  # [kind, dict, field_names, idx]
+
+    def read_iterative(self) -> Any:
+        # 与 read 的结果完全一致，但使用显式栈代替递归，嵌套深度不受 python 递归深度限制
+        steps = self.read_sliced(None, None)
+        try:
+            while True:
+                next(steps)
+        except StopIteration as e:
+            return e.value
+
+    def read_sliced(self, slice_bytes: Optional[int] = None, slice_seconds: Optional[float] = 0.005) -> Generator[None, None, Any]:
+        """
+        分片读取，结果与 read_iterative 一致。每读取 slice_bytes 字节或者耗时 slice_seconds 秒后 yield 一次，读完后通过 StopIteration.value 返回结果
+
+        显式栈保存在生成器中，ref 表、class 表和 type 表保存在对象中，yield 期间可以处理其他任务。单个字符串或 binary 不会被拆分
+        """
+        reader = self._reader
+        check_interval = min(slice_bytes if slice_bytes is not None else inf, 4096 if slice_seconds is not None else inf)  # 每读取多少字节检查一次
+        slice_end = reader.pos() + slice_bytes if slice_bytes is not None else inf
+        deadline = perf_counter() + slice_seconds if slice_seconds is not None else None
+        next_check = reader.pos() + check_interval
+
+        stack: List[list] = []
+        while True:
+            if reader.pos() >= next_check:
+                if reader.pos() >= slice_end or (deadline is not None and perf_counter() >= deadline):
+                    yield
+                    slice_end = reader.pos() + slice_bytes if slice_bytes is not None else inf
+                    deadline = perf_counter() + slice_seconds if slice_seconds is not None else None
+                next_check = reader.pos() + check_interval
+
+            b = self._reader.look_byte()
+            family = _TAG_FAMILIES[b]
+            if b == 0x5a and stack and (stack[-1][0] == self._FRAME_VARIABLE_LIST or (stack[-1][0] == self._FRAME_MAP and not stack[-1][3])):
+                # 变长 list 或 map 结束
+                self._reader.skip()
+                v = self._finish_frame(stack.pop())
+            elif family == 'list' or family == 'map' or family == 'object':
+                frame = self._begin_frame(family)
+                if not self._is_frame_complete(frame):
+                    stack.append(frame)
+                    continue
+                v = self._finish_frame(frame)
+            elif b == 0x43:
+                self._read_leading_class_def()
+                continue
+            else:
+                v = self.read()
+
+            # 将值放入上层容器，容器读满时继续向上传递
+            while stack:
+                frame = stack[-1]
+                if not self._add_to_frame(frame, v):
+                    break
+                stack.pop()
+                v = self._finish_frame(frame)
+            else:
+                return v
+
+    def _read_leading_class_def(self) -> None:
+        # read_sliced 中容器之前的 class 定义，单独作为一个方法以便 stats 统计
+        self.read_class_def()
+
+    def _begin_frame(self, family: str) -> list:
+        if family == 'list':
+            length, cls_name = self._read_list_header()
+            l = self._new_list(length, cls_name)
+            if length < 0:
+                return [self._FRAME_VARIABLE_LIST, l]
+            return [self._FRAME_FIXED_LIST, l, length, 0]
+        if family == 'map':
+            return [self._FRAME_MAP, self._read_map_header(), None, False]
+        v, cls_definition = self._read_object_header()
+        return [self._FRAME_OBJECT, v, cls_definition.field_names, 0]
+
+    def _is_frame_complete(self, frame: list) -> bool:
+        if frame[0] == self._FRAME_FIXED_LIST:
+            return frame[2] == 0
+        if frame[0] == self._FRAME_OBJECT:
+            return not frame[2]
+        return False
+
+    def _add_to_frame(self, frame: list, v: Any) -> bool:
+        # 返回 True 表示容器已经读满
+        kind = frame[0]
+        if kind == self._FRAME_FIXED_LIST:
+            frame[1][frame[3]] = v
+            frame[3] += 1
+            return frame[3] == frame[2]
+        if kind == self._FRAME_VARIABLE_LIST:
+            frame[1].append(v)
+            return False
+        if kind == self._FRAME_MAP:
+            if frame[3]:
+                frame[1][frame[2]] = v
+                frame[2] = None
+                frame[3] = False
+            else:
+                frame[2] = v
+                frame[3] = True
+            return False
+        frame[1][frame[2][frame[3]]] = v
+        frame[3] += 1
+        return frame[3] == len(frame[2])
+
+    def _finish_frame(self, frame: list) -> Any:
+        return frame[1]
+
     def read_null(self) -> None:
         # null ::= 'N'
         self._reader.skip()
@@ -670,32 +2018,69 @@ class Hessian2Deserializer:
         if b == 0x41:  # read non-final chunk until final chunk
             while b == 0x41:
                 l, = unpack('>h', self._reader.next_bytes(2))
-                buf.extend(self._reader.next_bytes(l))
+                buf.extend(self._read_binary_chunk(l))
                 b = self._reader.next_byte()
         if b == 0x42:
             l, = unpack('>h', self._reader.next_bytes(2))
-            buf.extend(self._reader.next_bytes(l))
+            buf.extend(self._read_binary_chunk(l))
             return bytes(buf)
         if 0x20 <= b <= 0x2f:
             l = b - 0x20
-            buf.extend(self._reader.next_bytes(l))
+            buf.extend(self._read_binary_chunk(l))
             return bytes(buf)
         if 0x34 <= b <= 0x37:
             l = ((b - 0x34) << 8) + self._reader.next_byte()
-            buf.extend(self._reader.next_bytes(l))
+            buf.extend(self._read_binary_chunk(l))
             return bytes(buf)
         raise ValueError(f'token error {b} at {self._reader.pos()}')
 
-    def read_datetime(self) -> datetime:
+    def _read_binary_chunk(self, length: int) -> bytes:
+        # 单独作为一个方法以便 limits 在读取每个 chunk 之前检查长度
+        return self._reader.next_bytes(length)
+
+    def _read_bytes_to_sink(self) -> Any:
+        b = self._reader.look_byte()
+        if b != 0x41 and b != 0x42:
+            return Hessian2Deserializer.read_bytes(self)  # 不分 chunk 的 binary 最长 1023 字节
+
+        data = memoryview(self._reader.raw_data_unsafe())
+        buf = bytearray()
+        sink = None
+        while True:
+            b = self._reader.next_byte()
+            if b == 0x41 or b == 0x42:
+                l, = unpack('>H', self._reader.next_bytes(2))
+            elif 0x20 <= b <= 0x2f:  # 最后一个 chunk 可能使用短格式
+                l = b - 0x20
+            elif 0x34 <= b <= 0x37:
+                l = ((b - 0x34) << 8) + self._reader.next_byte()
+            else:
+                raise ValueError(f'token error {b} at {self._reader.pos()}')
+            chunk = data[self._reader.pos():self._reader.pos() + l]
+            self._reader.skip(l)
+
+            if sink is None and len(buf) + l > self._binary_sink_threshold:
+                sink = self._binary_sink()
+                sink.write(buf)
+                buf = None
+            if sink is None:
+                buf.extend(chunk)
+            else:
+                sink.write(chunk)
+
+            if b != 0x41:
+                return bytes(buf) if sink is None else sink
+
+    def read_datetime(self) -> Union[datetime, int]:
         # date ::= x4a b7 b6 b5 b4 b3 b2 b1 b0
         #      ::= x4b b3 b2 b1 b0       # minutes since epoch
         b = self._reader.next_byte()
         if b == 0x4a:
             v, = unpack('>q', self._reader.next_bytes(8))
-            return datetime.fromtimestamp(v / 1000)
+            return self._date_converter(v)
         if b == 0x4b:
             v, = unpack('>l', self._reader.next_bytes(4))
-            return datetime.fromtimestamp(v * 60)
+            return self._date_converter(v * 60000)
         raise ValueError(f'token error {b} at {self._reader.pos()}')
 
     def read_list(self) -> list:
@@ -705,61 +2090,61 @@ class Hessian2Deserializer:
         #      ::= x58 int value*        # fixed-length untyped list
         #      ::= [x70-77] type value*  # fixed-length typed list
         #      ::= [x78-7f] value*       # fixed-length untyped list
+        length, cls_name = self._read_list_header()
+        if length < 0:
+            return self._read_variable_length_list(cls_name)
+        return self._read_fixed_length_list(length, cls_name)
+
+    def _read_list_header(self) -> Tuple[int, Optional[str]]:
+        # 返回 (length, cls_name)，变长 list 的 length 为 -1
         b = self._reader.next_byte()
         if b == 0x55:
-            cls_name = self.read_type()
-            return self._read_variable_length_list(cls_name)
+            return -1, self.read_type()
         if b == 0x56:
             cls_name = self.read_type()
-            length = self.read_int()
-            return self._read_fixed_length_list(length, cls_name)
+            return self.read_int(), cls_name
         if b == 0x57:
-            return self._read_variable_length_list()
+            return -1, None
         if b == 0x58:
-            length = self.read_int()
-            return self._read_fixed_length_list(length)
+            return self.read_int(), None
         if 0x70 <= b <= 0x77:
-            cls_name = self.read_type()
-            return self._read_fixed_length_list(b - 0x70, cls_name)
+            return b - 0x70, self.read_type()
         if 0x78 <= b <= 0x7f:
-            length = b - 0x78
-            return self._read_fixed_length_list(length)
+            return b - 0x78, None
         raise ValueError(f'token error {b} at {self._reader.pos()}')
 
-    def _read_fixed_length_list(self, length: int, cls_name: str = None) -> Union[list, UserList]:
-        l = [None] * length
+    def _read_fixed_length_list(self, length: int, cls_name: str = None) -> list:
+        l = self._new_list(length, cls_name)
         for i in range(length):
             l[i] = self.read()
-        if cls_name:
-            typed_list = UserList(l)
-            typed_list.__dict__['#class'] = cls_name
-            return typed_list
         return l
 
-    def _read_variable_length_list(self, cls_name: str = None) -> Union[list, UserList]:
-        l = []
+    def _read_variable_length_list(self, cls_name: str = None) -> list:
+        l = self._new_list(-1, cls_name)
         while True:
             b = self._reader.look_byte()
             if b == 0x5a:
                 self._reader.skip()
                 break
             l.append(self.read())
+        return l
+
+    def _new_list(self, length: int, cls_name: Optional[str]) -> list:
+        # list 在读取元素之前就要加入 ref 表，元素中可能存在指向它的 ref
+        if length > len(self._reader.raw_data_unsafe()) - self._reader.pos():
+            # 每个元素至少占用 1 字节，避免按错误或恶意的长度预先分配大量内存
+            raise ValueError(f'list length {length} exceeds remaining data at {self._reader.pos()}')
         if cls_name:
-            typed_list = UserList(l)
-            typed_list.__dict__['#class'] = cls_name
-            return typed_list
+            l = TypedList([None] * length if length > 0 else (), cls_name)
+        else:
+            l = [None] * length if length > 0 else []
+        self._refs.append(l)
         return l
 
     def read_map(self) -> dict:
         # map ::= 'M' type (value value)* 'Z'  # key, value map pairs
         # 	  ::= 'H' (value value)* 'Z'       # untyped key, value
-        v = {}
-        self._refs.append(v)
-        b = self._reader.next_byte()
-        if b == 0x4d:
-            v['#class'] = self.read_type()
-        elif b != 0x48:
-            raise ValueError(f'token error {b} at {self._reader.pos()}')
+        v = self._read_map_header()
 
         b = self._reader.look_byte()
         while b != 0x5a:
@@ -770,9 +2155,25 @@ class Hessian2Deserializer:
 
         return v
 
+    def _read_map_header(self) -> dict:
+        v = {}
+        self._refs.append(v)
+        b = self._reader.next_byte()
+        if b == 0x4d:
+            v['#class'] = self.read_type()
+        elif b != 0x48:
+            raise ValueError(f'token error {b} at {self._reader.pos()}')
+        return v
+
     def read_object(self) -> dict:
         # object ::= 'O' int value*
         #        ::= [x60-x6f] value*
+        v, cls_definition = self._read_object_header()
+        for field_name in cls_definition.field_names:
+            v[field_name] = self.read()
+        return v
+
+    def _read_object_header(self) -> Tuple[dict, _ClsDefinition]:
         b = self._reader.next_byte()
         if b == 0x4f:
             cls_definition = self._cls_definitions[self.read_int()]
@@ -781,9 +2182,24 @@ class Hessian2Deserializer:
         else:
             raise ValueError(f'token error {b} at {self._reader.pos()}')
         v = {'#class': cls_definition.cls_name}
-        for field_name in cls_definition.field_names:
-            v[field_name] = self.read()
-        return v
+        self._refs.append(v)
+        return v, cls_definition
+
+    def _read_record_header(self) -> Tuple[Hessian2Record, _ClsDefinition]:
+        b = self._reader.next_byte()
+        if b == 0x4f:
+            idx = self.read_int()
+        elif 0x60 <= b <= 0x6f:
+            idx = b - 0x60
+        else:
+            raise ValueError(f'token error {b} at {self._reader.pos()}')
+        cls_definition = self._cls_definitions[idx]
+        record_type = self._record_types.get(idx)
+        if record_type is None:
+            record_type = self._record_types[idx] = _record_type(cls_definition.cls_name, tuple(cls_definition.field_names))
+        v = record_type()
+        self._refs.append(v)
+        return v, cls_definition
 
     def _try_read_special_object(self, o: dict) -> Any:
         b = self._reader.look_byte()
@@ -818,5 +2234,876 @@ class Hessian2Deserializer:
         return cls_definition
 
 
+class Hessian2JsonTranscoder(Hessian2Deserializer):
+    """
+    沿用 Hessian2Deserializer 的语法解析，但容器不构建 python 对象，而是直接写出 json 文本。使用显式栈，内存占用只与嵌套深度有关
+
+    refs='copy' 时为每个容器记录起始位置，遇到 ref 时回到该位置重新输出一遍
+    """
+    _FRAME_VARIABLE_LIST = 0  # [kind, start, count]
+    _FRAME_MAP = 1  # [kind, start, count, has_key, has_cls_name]
+    _FRAME_FIXED_LIST = 2  # [kind, start, count, length]
+    _FRAME_OBJECT = 3  # [kind, start, count, field_names]
+
+    def __init__(self, data: bytes, out: Any, **kwargs):
+        from json.encoder import encode_basestring, encode_basestring_ascii
+
+        super().__init__(data, **kwargs)
+        self._date_converter = _DATE_CONVERTERS[DateMode.MILLIS]
+        self._write = out.write
+        self._encode_string = encode_basestring_ascii if kwargs.get('ensure_ascii') else encode_basestring
+        self._binary_format: str = kwargs.get('binary', 'base64')
+        self._date_format: str = kwargs.get('date_format', 'iso')
+        self._class_key: Optional[str] = kwargs.get('class_key', '#class')
+        self._ref_mode: str = kwargs.get('refs', 'marker')
+        self._ref_offsets: List[int] = []  # refs='copy' 时每个容器的起始位置
+        self._open_offsets = set()  # 正在输出的容器的起始位置，用于发现循环引用
+        self._replaying = 0
+
+    def transcode(self) -> None:
+        # 输出一个完整的值
+        write = self._write
+        reader = self._reader
+        stack: List[list] = []
+        while True:
+            if stack:
+                frame = stack[-1]
+                kind = frame[0]
+                if (kind == self._FRAME_VARIABLE_LIST or (kind == self._FRAME_MAP and not frame[3])) and reader.look_byte() == 0x5a:
+                    reader.skip()
+                    self._close_frame(stack.pop())
+                    if not stack:
+                        return
+                    continue
+                if (kind == self._FRAME_FIXED_LIST and frame[2] == frame[3]) or (kind == self._FRAME_OBJECT and frame[2] == len(frame[3])):
+                    self._close_frame(stack.pop())
+                    if not stack:
+                        return
+                    continue
+
+                if kind == self._FRAME_MAP:
+                    if frame[3]:
+                        write(':')
+                        frame[3] = False
+                    else:
+                        if frame[2] or (self._class_key and frame[4]):
+                            write(',')
+                        frame[2] += 1
+                        write(self._read_key())
+                        frame[3] = True
+                        continue
+                elif kind == self._FRAME_OBJECT:
+                    if frame[2] or self._class_key:
+                        write(',')
+                    write(self._encode_string(str(frame[3][frame[2]])))
+                    write(':')
+                    frame[2] += 1
+                else:
+                    if frame[2]:
+                        write(',')
+                    frame[2] += 1
+
+            b = reader.look_byte()
+            while b == 0x43:
+                self.read_class_def()
+                b = reader.look_byte()
+
+            family = _TAG_FAMILIES[b]
+            if family == 'list' or family == 'map' or family == 'object':
+                stack.append(self._open_frame(family))
+                continue
+            if family == 'ref':
+                self._write_ref()
+            else:
+                self._write_scalar(family)
+            if not stack:
+                return
+
+    def _open_frame(self, family: str) -> list:
+        start = self._reader.pos()
+        if not self._replaying and self._ref_mode == 'copy':
+            self._ref_offsets.append(start)
+        self._open_offsets.add(start)
+
+        if family == 'list':
+            length, _ = self._read_list_header()
+            self._write('[')
+            if length < 0:
+                return [self._FRAME_VARIABLE_LIST, start, 0]
+            return [self._FRAME_FIXED_LIST, start, 0, length]
+
+        if family == 'map':
+            b = self._reader.next_byte()
+            cls_name = self.read_type() if b == 0x4d else None
+            self._write('{')
+            if cls_name and self._class_key:
+                self._write(self._encode_string(self._class_key) + ':' + self._encode_string(cls_name))
+            return [self._FRAME_MAP, start, 0, False, bool(cls_name)]
+
+        b = self._reader.next_byte()
+        cls_definition = self._cls_definitions[self.read_int() if b == 0x4f else b - 0x60]
+        self._write('{')
+        if self._class_key:
+            self._write(self._encode_string(self._class_key) + ':' + self._encode_string(cls_definition.cls_name))
+        return [self._FRAME_OBJECT, start, 0, cls_definition.field_names]
+
+    def _close_frame(self, frame: list) -> None:
+        self._open_offsets.discard(frame[1])
+        self._write(']' if frame[0] == self._FRAME_VARIABLE_LIST or frame[0] == self._FRAME_FIXED_LIST else '}')
+
+    def _read_key(self) -> str:
+        # json 的 key 只能是字符串，其他类型的 key 按 json 文本转为字符串
+        family = _TAG_FAMILIES[self._reader.look_byte()]
+        if family == 'string':
+            return self._encode_string(self.read_string())
+        if family in ('list', 'map', 'object', 'ref', 'class_def'):
+            raise ValueError(f'unsupported map key {family} at {self._reader.pos()}')
+        return self._encode_string(self._scalar_to_json(family))
+
+    def _write_scalar(self, family: str) -> None:
+        if family == 'string':
+            self._write(self._encode_string(self.read_string()))
+        else:
+            self._write(self._scalar_to_json(family))
+
+    def _scalar_to_json(self, family: str) -> str:
+        if family == 'date':
+            ms = self.read_datetime()
+            if self._date_format == 'millis':
+                return str(ms)
+            return '"' + (_UTC_EPOCH + timedelta(milliseconds=ms)).isoformat() + '"'
+        if family == 'binary':
+            v = self.read_bytes()
+            if self._binary_format == 'hex':
+                return '"' + v.hex() + '"'
+            from base64 import b64encode
+
+            return '"' + b64encode(v).decode('ascii') + '"'
+        v = self.read()
+        if v is None:
+            return 'null'
+        if v is True:
+            return 'true'
+        if v is False:
+            return 'false'
+        if isinstance(v, float) and not isfinite(v):
+            return 'NaN' if v != v else ('Infinity' if v > 0 else '-Infinity')
+        if isinstance(v, str):
+            return self._encode_string(v)
+        return repr(v)
+
+    def _write_ref(self) -> None:
+        self._reader.skip()
+        idx = self.read_int()
+        if self._ref_mode == 'null':
+            self._write('null')
+        elif self._ref_mode == 'copy' and self._ref_offsets[idx] not in self._open_offsets:
+            pos = self._reader.pos()
+            self._reader.seek(self._ref_offsets[idx])
+            self._replaying += 1
+            try:
+                self.transcode()
+            finally:
+                self._replaying -= 1
+                self._reader.seek(pos)
+        else:
+            self._write('{"$ref":%d}' % idx)
+
+    def read_type(self) -> str:
+        # 重新输出被引用的值时，其中的 type 和 class 定义已经读取过，不能重复加入
+        n = len(self._type_names)
+        t = super().read_type()
+        if self._replaying:
+            del self._type_names[n:]
+        return t
+
+    def read_class_def(self) -> Hessian2Deserializer._ClsDefinition:
+        cls_definition = super().read_class_def()
+        if self._replaying:
+            self._cls_definitions.pop()
+        return cls_definition
+
+
+_TERMINAL = object()  # 路径前缀树中表示路径结束的 key
+
+
+def _build_path_trie(paths: Optional[Collection[str]]) -> Optional[dict]:
+    if paths is None:
+        return None
+    trie = {}
+    for path in paths:
+        node = trie
+        for name in path.split('.'):
+            node = node.setdefault(name, {})
+        node[_TERMINAL] = True
+    return trie
+
+
+class Hessian2Rewriter(Hessian2Deserializer):
+    """
+    逐个 token 复制 hessian 字节流，可以按 Projection 删除字段或替换对象为 null
+
+    标量按原始字节复制；type、class 定义和 ref 的编号写入一个新的 Hessian2Serializer 中重新计算。
+    被跳过的部分仍然会解析，以维护原始消息的 type 表、class 表和 ref 编号。被跳过的容器在保留的位置再次被引用时，回到其原始位置重新输出
+    """
+
+    def __init__(self, data: bytes, projection: Projection = None, **kwargs):
+        super().__init__(data, **kwargs)
+        projection = projection or Projection()
+        self._out: Hessian2Serializer = kwargs.get('out') or Hessian2Serializer()
+        self._ref_map: List[Optional[int]] = []  # 原始 ref 编号 -> 新的 ref 编号，未写出的为 None
+        self._ref_offsets: List[int] = []  # 原始 ref 编号 -> 容器的起始位置，被 drop_classes 删除的为 -1
+        self._container_start = 0  # 正在处理的容器的起始位置
+        self._replay_next = -1  # 重新输出被跳过的容器时，下一个容器的原始 ref 编号
+        self._drop_trie = _build_path_trie(projection.drop_paths)
+        self._keep_trie = _build_path_trie(projection.keep_paths)
+        self._drop_fields = {k: frozenset(v) for k, v in (projection.drop_fields or {}).items()}
+        self._drop_classes = frozenset(projection.drop_classes)
+
+    def export(self) -> bytes:
+        return self._out.export()
+
+    def rewrite(self) -> None:
+        self._copy_value(([self._drop_trie], None if self._keep_trie is None else [self._keep_trie]), True)
+
+    def _child_state(self, state: tuple, name: Any) -> Tuple[bool, tuple]:
+        # 返回 (是否保留字段, 字段的路径状态)，路径状态是 (drop 前缀树节点, keep 前缀树节点)，keep 为 None 表示全部保留
+        drop_nodes, keep_nodes = state
+        if not isinstance(name, str):
+            return keep_nodes is None, ([], keep_nodes)
+        drop_nodes = [n[k] for n in drop_nodes for k in (name, '*') if k in n]
+        dropped = any(_TERMINAL in n for n in drop_nodes)
+        if keep_nodes is not None:
+            keep_nodes = [n[k] for n in keep_nodes for k in (name, '*') if k in n]
+            if not keep_nodes:
+                return False, (drop_nodes, keep_nodes)
+            if any(_TERMINAL in n for n in keep_nodes):
+                keep_nodes = None
+        return not dropped, (drop_nodes, keep_nodes)
+
+    def _copy_value(self, state: tuple, emit: bool) -> None:
+        # emit 为 False 时只解析不输出
+        b = self._reader.look_byte()
+        while b == 0x43:
+            self.read_class_def()  # class 定义在第一次写出使用它的 object 时重新输出
+            b = self._reader.look_byte()
+
+        family = _TAG_FAMILIES[b]
+        if family == 'list' or family == 'map' or family == 'object':
+            if emit and self._replay_next >= 0:
+                new_idx = self._ref_map[self._replay_next]
+                if new_idx is not None:  # 重新输出的容器中包含已经在其他位置输出过的容器
+                    self._out._write_ref(new_idx)
+                    emit = False
+            self._container_start = self._reader.pos()
+            if family == 'list':
+                self._copy_list(state, emit)
+            elif family == 'map':
+                self._copy_map(state, emit)
+            else:
+                self._copy_object(state, emit)
+        elif family == 'ref':
+            self._reader.skip()
+            old_idx = self.read_int()
+            if emit:
+                new_idx = self._ref_map[old_idx]
+                if new_idx is not None:
+                    self._out._write_ref(new_idx)
+                elif self._ref_offsets[old_idx] < 0:
+                    self._out.write_null()
+                else:
+                    self._replay(old_idx, state)
+        else:
+            start = self._reader.pos()
+            self.read()
+            if emit:
+                self._out._bytes.extend(self._reader.raw_data_unsafe()[start:self._reader.pos()])
+
+    def _replay(self, old_idx: int, state: tuple) -> None:
+        # 按 ref 所在位置的路径规则重新输出被跳过的容器，此后指向它的 ref 都指向新输出的容器
+        reader = self._reader
+        pos, replay_next = reader.pos(), self._replay_next
+        n_types, n_classes = len(self._type_names), len(self._cls_definitions)
+        reader.seek(self._ref_offsets[old_idx])
+        self._replay_next = old_idx
+        self._copy_value(state, True)
+        reader.seek(pos)
+        self._replay_next = replay_next
+        # 重复读到的 type 和 class 定义追加在末尾，不影响已有的编号，读完后删除
+        del self._type_names[n_types:]
+        del self._cls_definitions[n_classes:]
+
+    def _register_ref(self, emit: bool) -> Optional[int]:
+        new_idx = None
+        if emit:
+            new_idx = self._out._ref_count
+            self._out._ref_count += 1
+        if self._replay_next < 0:
+            old_idx = len(self._ref_map)
+            self._ref_map.append(new_idx)
+            self._ref_offsets.append(self._container_start)
+        else:
+            old_idx = self._replay_next
+            self._replay_next += 1
+            if emit:
+                self._ref_map[old_idx] = new_idx
+        self._on_container(old_idx, new_idx)
+        return new_idx
+
+    def _on_container(self, old_idx: int, new_idx: Optional[int]) -> None:
+        pass
+
+    def _copy_list(self, state: tuple, emit: bool) -> None:
+        out = self._out
+        data = self._reader.raw_data_unsafe()
+        b = self._reader.next_byte()
+        self._register_ref(emit)
+        if emit:
+            out._bytes.append(b)
+        if b == 0x55 or b == 0x56 or 0x70 <= b <= 0x77:
+            cls_name = self.read_type()
+            if emit:
+                out._write_type(cls_name)
+        if b == 0x56 or b == 0x58:
+            start = self._reader.pos()
+            length = self.read_int()
+            if emit:
+                out._bytes.extend(data[start:self._reader.pos()])
+        elif b == 0x55 or b == 0x57:
+            length = -1
+        else:
+            length = (b - 0x70) if b <= 0x77 else (b - 0x78)
+
+        if length >= 0:
+            for _ in range(length):
+                self._copy_value(state, emit)
+        else:
+            while self._reader.look_byte() != 0x5a:
+                self._copy_value(state, emit)
+            self._reader.skip()
+            if emit:
+                out._bytes.append(0x5a)
+
+    def _copy_map(self, state: tuple, emit: bool) -> None:
+        out = self._out
+        data = self._reader.raw_data_unsafe()
+        b = self._reader.next_byte()
+        cls_name = self.read_type() if b == 0x4d else None
+        if cls_name in self._drop_classes:
+            if emit:
+                out.write_null()
+            emit = False
+            self._container_start = -1
+        self._register_ref(emit)
+        if emit:
+            out._bytes.append(b)
+            if cls_name:
+                out._write_type(cls_name)
+
+        drop_fields = self._drop_fields.get(cls_name, ())
+        while self._reader.look_byte() != 0x5a:
+            if _TAG_FAMILIES[self._reader.look_byte()] == 'string':
+                start = self._reader.pos()
+                key = self.read_string()
+                keep, child_state = self._child_state(state, key)
+                keep = keep and key not in drop_fields
+                if emit and keep:
+                    out._bytes.extend(data[start:self._reader.pos()])
+            else:
+                keep, child_state = self._child_state(state, None)
+                self._copy_value(child_state, emit and keep)
+            self._copy_value(child_state, emit and keep)
+        self._reader.skip()
+        if emit:
+            out._bytes.append(0x5a)
+
+    def _copy_object(self, state: tuple, emit: bool) -> None:
+        out = self._out
+        b = self._reader.next_byte()
+        cls_definition = self._cls_definitions[self.read_int() if b == 0x4f else b - 0x60]
+        if cls_definition.cls_name in self._drop_classes:
+            if emit:
+                out.write_null()
+            emit = False
+            self._container_start = -1
+        self._register_ref(emit)
+
+        drop_fields = self._drop_fields.get(cls_definition.cls_name, ())
+        fields = []
+        for field_name in cls_definition.field_names:
+            keep, child_state = self._child_state(state, field_name)
+            fields.append((keep and field_name not in drop_fields, child_state))
+
+        if emit:
+            kept_names = tuple(name for name, (keep, _) in zip(cls_definition.field_names, fields) if keep)
+            out._write_object_header(cls_definition.cls_name, kept_names)
+
+        for keep, child_state in fields:
+            self._copy_value(child_state, emit and keep)
+
+
+class Hessian2Message:
+    """
+    loads_tracked 的结果，value 是反序列化得到的对象，可以直接修改
+
+    dumps 时内容没有变化的容器（子孙与反序列化时是同一个对象）按原始字节复制；变化的容器重新写出头部，其中未变化的子元素仍然复制原始字节。
+    只修改过标量时 type、class 和 ref 编号与原始消息一致，未变化的容器整段复制；增删容器后逐个 token 复制，编号按新消息重新生成。
+    原地修改的 list / map / object 保持原来的顺序，object 的字段不变时仍然写出为 object
+    """
+
+    def __init__(self, data: bytes, **kwargs):
+        self._data = data
+        self._deserializer = _SpanDeserializer(data, **kwargs)
+        self.value = self._deserializer.read()
+
+    def dumps(self) -> bytes:
+        d = self._deserializer
+        serializer = _PatchSerializer()
+        serializer._copier = _SpanCopier(self._data, d._spans, d._refs, d._type_names, d._cls_definitions, out=serializer)
+        serializer.write(self.value)
+        return serializer.export()
+
+
+class _Span(NamedTuple):
+    start: int  # 在原始字节中的位置
+    end: int
+    ref_idx: int  # 容器本身的 ref 编号
+    ref_end: int  # 子孙容器之后的下一个 ref 编号
+    types: Tuple[int, int]  # 起止位置的 type 表大小
+    classes: Tuple[int, int]  # 起止位置的 class 表大小
+    aligned: bool  # 子元素是否与原始字节一一对应，map 中 key 重复时不对应
+    snapshot: tuple  # 反序列化时的子元素
+    children: tuple  # 在此容器内第一次出现的子容器，其余的子容器以 ref 引用，变化与否不影响复制
+
+
+class _SpanDeserializer(Hessian2Deserializer):
+    def __init__(self, data: bytes, **kwargs):
+        super().__init__(data, **kwargs)
+        self._spans: Dict[int, _Span] = {}  # key 是对象 id，对象由 _refs 持有，不会被回收
+
+    def read_list(self) -> list:
+        start, idx, types, classes = self._reader.pos(), len(self._refs), len(self._type_names), len(self._cls_definitions)
+        v = super().read_list()
+        self._add_span(v, start, idx, types, classes, True, (tuple(v), getattr(v, 'cls_name', None)))
+        return v
+
+    def read_map(self) -> dict:
+        start, idx, types, classes = self._reader.pos(), len(self._refs), len(self._type_names), len(self._cls_definitions)
+        v = self._read_map_header()
+        entries = 0
+        while self._reader.look_byte() != 0x5a:
+            k = self.read()
+            v[k] = self.read()
+            entries += 1
+        self._reader.skip()
+        aligned = entries == len(v) - ('#class' in v and self._reader.raw_data_unsafe()[start] == 0x4d)
+        self._add_span(v, start, idx, types, classes, aligned, (tuple(v), tuple(v.values())))
+        return v
+
+    def read_object(self) -> dict:
+        start, idx, types, classes = self._reader.pos(), len(self._refs), len(self._type_names), len(self._cls_definitions)
+        v, cls_definition = self._read_object_header()
+        for field_name in cls_definition.field_names:
+            v[field_name] = self.read()
+        self._add_span(v, start, idx, types, classes, len(v) == len(cls_definition.field_names) + 1, (tuple(v), tuple(v.values())))
+        return v
+
+    def _add_span(self, v: Any, start: int, idx: int, types: int, classes: int, aligned: bool, snapshot: tuple) -> None:
+        values = snapshot[1] if isinstance(v, dict) else snapshot[0]
+        children = tuple(e for e in values if not isinstance(e, _SCALAR_TYPES) and id(e) in self._spans and self._spans[id(e)].ref_idx > idx)
+        self._spans[id(v)] = _Span(start, self._reader.pos(), idx, len(self._refs), (types, len(self._type_names)),
+                                   (classes, len(self._cls_definitions)), aligned, snapshot, children)
+
+
+def _is_dirty(v: Any, snapshot: tuple) -> bool:
+    # 与反序列化时的快照逐个比较子元素是否为同一个对象
+    if isinstance(v, dict):
+        keys, values = snapshot
+        return len(v) != len(keys) or not all(map(is_, v, keys)) or not all(map(is_, v.values(), values))
+    items, cls_name = snapshot
+    return len(v) != len(items) or getattr(v, 'cls_name', None) != cls_name or not all(map(is_, v, items))
+
+
+_SCALAR_TYPES = (type(None), bool, int, float, str, bytes, datetime)
+
+
+class _PatchSerializer(Hessian2Serializer):
+    """
+    Hessian2Message.dumps 使用，遇到反序列化得到的容器时交给 _SpanCopier 复制原始字节
+    """
+    _copier: '_SpanCopier'
+
+    def write_list(self, v: Sequence[Any]) -> None:
+        self._copier.write(v, super().write_list)
+
+    def write_map(self, o: dict) -> None:
+        self._copier.write(o, super().write_map)
+
+
+class _SpanCopier(Hessian2Rewriter):
+    """
+    按需跳转到容器的原始位置复制字节。type 表和 class 表预先加载反序列化时的完整结果，因此可以从任意容器开始读取，
+    原始的 ref 编号映射为对象，由 _PatchSerializer 按对象 id 重新编号
+
+    输出与原始消息保持同步（只修改过标量，type、class、ref 编号与原始消息完全一致）时，未变化的容器整段复制，
+    否则逐个 token 复制并重新编号
+    """
+
+    def __init__(self, data: bytes, spans: Dict[int, _Span], refs: List[Any], type_names: List[str],
+                 cls_definitions: List[Hessian2Deserializer._ClsDefinition], **kwargs):
+        super().__init__(data, **kwargs)
+        self._spans = spans
+        self._orig_refs = refs
+        self._type_names = list(type_names)  # 复制原始字节时重复读到的定义追加在末尾，不影响已有的编号
+        self._cls_definitions = list(cls_definitions)
+        self._orig_type_names = type_names
+        self._orig_cls_keys = [(c.cls_name, tuple(c.field_names)) for c in cls_definitions]
+        self._next_ref = 0  # 下一个容器的原始 ref 编号
+        self._root_state = ([self._drop_trie], None)
+        self._clean: Dict[int, bool] = {}
+        # 重复的定义在 Hessian2Serializer 中无法表示，此时不能整段复制
+        self._synced = len(set(type_names)) == len(type_names) and len(set(self._orig_cls_keys)) == len(self._orig_cls_keys)
+
+    def copy(self, v: Any) -> bool:
+        # 返回 False 表示不是反序列化得到的容器，或者已经写出过，由调用方正常写出
+        span = self._spans.get(id(v))
+        if span is None or id(v) in self._out._refs:
+            return False
+        pos, next_ref = self._reader.pos(), self._next_ref
+        self._reader.seek(span.start)
+        self._next_ref = span.ref_idx
+        copied = True
+        if self._is_clean(v):
+            self._copy_clean(span)
+        elif not span.aligned or not self._copy_dirty(v, span.snapshot):
+            copied = False
+        self._reader.seek(pos)
+        self._next_ref = next_ref
+        return copied
+
+    def write(self, v: Any, fallback: Callable[[Any], None]) -> None:
+        if self.copy(v):
+            return
+        # 完整写出后，ref 编号和新增的 type、class 定义与原始消息一致时，后续的容器仍然可以整段复制
+        span = self._spans.get(id(v))
+        synced = self._synced and span is not None and id(v) not in self._out._refs and self._out._ref_count == span.ref_idx
+        fallback(v)
+        self._synced = synced and self._in_sync(span)
+
+    def _in_sync(self, span: _Span) -> bool:
+        out = self._out
+        if out._ref_count != span.ref_end or len(out._type_names) != span.types[1] or len(out._class_definitions) != span.classes[1]:
+            return False
+        if any(out._refs.get(id(self._orig_refs[i])) != i for i in range(span.ref_idx, span.ref_end)):
+            return False
+        return all(self._orig_type_names[i] == n for n, i in out._type_names.items() if i >= span.types[0]) and \
+            all(self._orig_cls_keys[i] == k for k, i in out._class_definitions.items() if i >= span.classes[0])
+
+    def _is_clean(self, v: Any) -> bool:
+        # 容器及其在原始字节中内联的子孙都没有变化
+        key = id(v)
+        clean = self._clean.get(key)
+        if clean is None:
+            span = self._spans.get(key)
+            clean = self._clean[key] = span is not None and not _is_dirty(v, span.snapshot) and all(map(self._is_clean, span.children))
+        return clean
+
+    def _copy_clean(self, span: _Span) -> None:
+        out = self._out
+        if not (self._synced and out._ref_count == span.ref_idx and len(out._type_names) == span.types[0]
+                and len(out._class_definitions) == span.classes[0]):
+            super()._copy_value(self._root_state, True)
+            return
+
+        out._bytes.extend(memoryview(self._reader.raw_data_unsafe())[span.start:span.end])
+        for i in range(span.types[0], span.types[1]):
+            out._type_names[self._orig_type_names[i]] = i
+        for i in range(span.classes[0], span.classes[1]):
+            out._class_definitions[self._orig_cls_keys[i]] = i
+        for i in range(span.ref_idx, span.ref_end):
+            out._refs[id(self._orig_refs[i])] = i
+        out._ref_count = span.ref_end
+        self._reader.seek(span.end)
+        self._next_ref = span.ref_end
+
+    def _copy_dirty(self, v: Any, snapshot: tuple) -> bool:
+        # 重新写出头部，未变化的子元素复制原始字节。返回 False 表示无法保留原来的结构，由调用方完整写出
+        out = self._out
+        family = _TAG_FAMILIES[self._reader.look_byte()]
+        if family == 'list':
+            items, cls_name = snapshot
+            if len(v) != len(items):
+                return False
+            length, _ = self._read_list_header()
+            self._next_ref += 1
+            if getattr(v, 'cls_name', None) != cls_name:
+                self._synced = False
+            out._write_list_header(v)
+            for e, orig in zip(v, items):
+                self._copy_child(e, orig)
+            if length < 0:
+                self._reader.skip()  # 'Z'
+            return True
+
+        if family == 'map':
+            keys, values = snapshot
+            if self._reader.next_byte() == 0x4d:
+                self.read_type()
+            self._next_ref += 1
+            if v.get('#class') != dict(zip(keys, values)).get('#class'):
+                self._synced = False
+            out._write_map_header(v)
+            written = set()
+            for k, orig in zip(keys, values):
+                if k == '#class':
+                    continue
+                keep = k in v
+                self._copy_value(self._root_state, keep)
+                if keep:
+                    written.add(k)
+                    self._copy_child(v[k], orig)
+                else:
+                    self._copy_value(self._root_state, False)
+            self._reader.skip()  # 'Z'
+            for k, e in v.items():
+                if k != '#class' and k not in written:
+                    self._write_new(k)
+                    self._write_new(e)
+            out._bytes.append(0x5a)
+            return True
+
+        # object 的字段不变时仍然写出为 object，否则由调用方写出为带类型的 map
+        keys, values = snapshot
+        b = self._reader.next_byte()
+        cls_definition = self._cls_definitions[self.read_int() if b == 0x4f else b - 0x60]
+        if tuple(v) != keys or not isinstance(v['#class'], str):
+            return False
+        self._next_ref += 1
+        if v['#class'] != values[0]:
+            self._synced = False
+        out._try_write_ref(v)
+        out._write_object_header(v['#class'], tuple(cls_definition.field_names))
+        for field_name, orig in zip(keys[1:], values[1:]):
+            self._copy_child(v[field_name], orig)
+        return True
+
+    def _copy_child(self, v: Any, orig: Any) -> None:
+        if v is orig:
+            self._copy_value(self._root_state, True)
+        else:
+            self._copy_value(self._root_state, False)
+            self._write_new(v)
+
+    def _write_new(self, v: Any) -> None:
+        if not isinstance(v, _SCALAR_TYPES):
+            self._synced = False
+        self._out.write(v)
+
+    def _copy_value(self, state: tuple, emit: bool) -> None:
+        b = self._reader.look_byte()
+        while b == 0x43:
+            self.read_class_def()
+            b = self._reader.look_byte()
+
+        family = _TAG_FAMILIES[b]
+        if family == 'ref':
+            self._reader.skip()
+            v = self._orig_refs[self.read_int()]
+            if emit:
+                if id(v) not in self._out._refs:
+                    self._synced = False
+                self._out.write(v)
+            return
+        if family == 'list' or family == 'map' or family == 'object':
+            v = self._orig_refs[self._next_ref]
+            span = self._spans[id(v)]
+            if emit and id(v) not in self._out._refs and self._is_clean(v):
+                self._copy_clean(span)
+                return
+            # 跳过原始字节，需要时按新的内容写出。未写出过的容器由 copy 回到原始位置处理
+            if not emit or id(v) in self._out._refs:
+                self._synced = False
+            self._reader.seek(span.end)
+            self._next_ref = span.ref_end
+            if emit:
+                self._out.write(v)
+            return
+        super()._copy_value(state, emit)
+
+    def _register_ref(self, emit: bool) -> Optional[int]:
+        v = self._orig_refs[self._next_ref]
+        self._next_ref += 1
+        new_idx = self._out._ref_count
+        self._out._ref_count += 1
+        self._out._refs[id(v)] = new_idx
+        return new_idx
+
+
+class Hessian2Inspector(Hessian2Deserializer):
+    """
+    在反序列化的同时记录每个值的位置，统计字段、字符串、class 定义的字节数，供 inspect_payload 使用。tag 和 java 类的统计由 Hessian2Stats 完成
+
+    使用 read_iterative 读取，嵌套深度不受 python 递归深度限制。每个 map / object 的 frame 对应 _frame_info 中的一项
+    """
+
+    def __init__(self, data: bytes, **kwargs):
+        super().__init__(data, **kwargs)
+        self._fields: Dict[str, Dict[Any, List[int]]] = {}  # java 类名 -> 字段名 -> [count, bytes]
+        self._class_def_counts: Dict[str, int] = {}  # java 类名 -> class 定义次数
+        self._strings: Dict[str, List[int]] = {}  # 字符串 -> [count, bytes]
+        self._typed_maps: Dict[Tuple[str, tuple], List[int]] = {}  # (java 类名, 字段名) -> [count, 类型和字段名占用的字节数]
+        self._objects = 0
+        self._frame_info: List[list] = []  # [当前元素的起始位置, java 类名, 类型、字段名、头部和结束符的字节数, key 的起始位置, key 列表]
+
+    def inspect(self) -> None:
+        data = self._reader.raw_data_unsafe()
+        while self._reader.pos() < len(data):
+            self.read_iterative()
+            # 拼接的消息各自独立编号
+            self._refs.clear()
+            self._cls_definitions.clear()
+            self._type_names.clear()
+
+    def report(self, snapshot: dict, top: int) -> dict:
+        containers = sum(snapshot['tags'].get(family, {}).get('count', 0) for family in ('list', 'map', 'object'))
+        strings = sorted(self._strings.items(), key=lambda e: (e[1][0] - 1) * e[1][1] // e[1][0], reverse=True)
+        class_definitions = sum(self._class_def_counts.values())
+        return {
+            'messages': snapshot['messages'],
+            'bytes': len(self._reader.raw_data_unsafe()),
+            'tags': {k: {'count': v['count'], 'bytes': v['bytes']} for k, v in snapshot['tags'].items()},
+            'classes': {cls_name: {
+                'count': counter['count'],
+                'bytes': counter['bytes'],
+                'class_definitions': self._class_def_counts.get(cls_name, 0),
+                'fields': {str(k): {'count': c, 'bytes': b} for k, (c, b) in self._fields.get(cls_name, {}).items()},
+            } for cls_name, counter in snapshot['classes'].items()},
+            'strings': {
+                'count': sum(c for c, _ in self._strings.values()),
+                'unique': len(self._strings),
+                'bytes': sum(b for _, b in self._strings.values()),
+                'top': [{'value': k[:100], 'count': c, 'bytes': b} for k, (c, b) in strings[:top] if c > 1],
+            },
+            'refs': {
+                'count': snapshot['ref_hits'],
+                'hit_rate': snapshot['ref_hits'] / (snapshot['ref_hits'] + containers) if containers else 0.0,
+            },
+            'class_definitions': {
+                'count': class_definitions,
+                'objects': self._objects,
+                'reuse': self._objects / class_definitions if class_definitions else 0.0,
+            },
+            'savings': {
+                'compact_objects': self._compact_object_savings(),
+                'string_interning': self._string_interning_savings(),
+            },
+        }
+
+    def _compact_object_savings(self) -> int:
+        # 每个带类型的 map 改为 object 后只需要 1 字节的头部（假设 class 定义编号小于 16），每种字段组合需要一个 class 定义
+        saved = 0
+        for (cls_name, keys), (count, overhead) in self._typed_maps.items():
+            class_def = Hessian2Serializer()
+            class_def._write_object_header(cls_name, keys)
+            saved += overhead - count - (len(class_def.export()) - 1)
+        return saved
+
+    def _string_interning_savings(self) -> int:
+        # 重复出现的字符串除第一次以外都改为约 2 字节的引用
+        return sum(max(0, b // c - 2) * (c - 1) for c, b in self._strings.values())
+
+    def read_string(self) -> str:
+        start = self._reader.pos()
+        v = super().read_string()
+        counter = self._strings.get(v)
+        if counter is None:
+            self._strings[v] = [1, self._reader.pos() - start]
+        else:
+            counter[0] += 1
+            counter[1] += self._reader.pos() - start
+        return v
+
+    def _begin_frame(self, family: str) -> list:
+        start = self._reader.pos()
+        frame = super()._begin_frame(family)
+        if frame[0] == self._FRAME_OBJECT:
+            self._objects += 1
+            cls_name = frame[1]['#class']
+        else:
+            cls_name = frame[1].get('#class') if frame[0] == self._FRAME_MAP else None
+        self._frame_info.append([self._reader.pos(), cls_name, self._reader.pos() - start + 1, 0, []])  # 头部、类型和结束符 'Z'
+        return frame
+
+    def _add_to_frame(self, frame: list, v: Any) -> bool:
+        info = self._frame_info[-1]
+        pos = self._reader.pos()
+        kind = frame[0]
+        if kind == self._FRAME_MAP:
+            if not frame[3]:  # v 是 key
+                try:
+                    hash(v)
+                except TypeError:
+                    raise ValueError(f'unhashable map key {type(v).__name__} at {pos}') from None
+                info[3] = info[0]
+            elif info[1]:
+                info[2] += info[0] - info[3]  # key 占用的字节数
+                info[4].append(frame[2])
+                self._add_field(info[1], frame[2], pos - info[0])
+        elif kind == self._FRAME_OBJECT:
+            self._add_field(info[1], frame[2][frame[3]], pos - info[0])
+        info[0] = pos
+        return super()._add_to_frame(frame, v)
+
+    def _finish_frame(self, frame: list) -> Any:
+        _, cls_name, overhead, _, keys = self._frame_info.pop()
+        if frame[0] == self._FRAME_MAP and cls_name and all(isinstance(k, str) for k in keys):
+            counter = self._typed_maps.setdefault((cls_name, tuple(keys)), [0, 0])
+            counter[0] += 1
+            counter[1] += overhead
+        return super()._finish_frame(frame)
+
+    def read_class_def(self) -> Hessian2Deserializer._ClsDefinition:
+        cls_definition = super().read_class_def()
+        self._class_def_counts[cls_definition.cls_name] = self._class_def_counts.get(cls_definition.cls_name, 0) + 1
+        return cls_definition
+
+    def _add_field(self, cls_name: str, field_name: Any, n_bytes: int) -> None:
+        counter = self._fields.setdefault(cls_name, {}).setdefault(field_name, [0, 0])
+        counter[0] += 1
+        counter[1] += n_bytes
+
+
+def main(argv: List[str] = None) -> int:
+    import json
+    from argparse import ArgumentParser
+    from struct import error as StructError
+
+    parser = ArgumentParser(prog='python -m hessian2', description='hessian2 tools')
+    sub = parser.add_subparsers(dest='command', required=True)
+    inspect_parser = sub.add_parser('inspect', help='report where the bytes of a payload go, as json')
+    inspect_parser.add_argument('file', help='payload file, may contain concatenated messages; - for stdin')
+    inspect_parser.add_argument('--top', type=int, default=20, help='number of repeated strings to report')
+    inspect_parser.add_argument('--indent', type=int, default=2, help='json indent')
+
+    args = parser.parse_args(argv)
+    if args.file == '-':
+        data = sys.stdin.buffer.read()
+    else:
+        with open(args.file, 'rb') as f:
+            data = f.read()
+    try:
+        result = inspect_payload(data, args.top)
+    except (ValueError, IndexError, AssertionError, StructError) as e:  # 截断或损坏的数据
+        print(f'invalid hessian payload: {e!r}', file=sys.stderr)
+        return 1
+    json.dump(result, sys.stdout, indent=args.indent, ensure_ascii=False)
+    print()
+    return 0
+
+
 def helloworld():
     return bytes(py3_hessian2_rsimpl.helloworld())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
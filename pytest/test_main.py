@@ -1,9 +1,18 @@
+import asyncio
+import collections
+import contextlib
+import dataclasses
 import datetime
+import io
+import json
 import os
+import tempfile
 import unittest
 from collections import UserList
 
-from hessian2 import dumps, loads
+from hessian2 import DateMode, Hessian2Deserializer, Hessian2FragmentCache, Hessian2LimitError, Hessian2Limits, Hessian2Record, Hessian2Stats, Projection, RawHessian, \
+    TypeConstants, TypedList, dumps, dumps_iov, dumps_parallel, dumps_raw, inspect_payload, loads, loads_async, loads_tracked, main, project, \
+    raw_from_bytes, register_class, transcode_json
 
 
 class Test(unittest.TestCase):
@@ -134,6 +143,7 @@ class Test(unittest.TestCase):
         self.assertEqual(dumps('\u00a9'), b'\x01\xc2\xa9')
         self.assertEqual(dumps('a' * 15), b'\x0f' + b'\x61' * 15)
         self.assertEqual(dumps('a' * 16), b'\x10' + b'\x61' * 16)
+        self.assertEqual(dumps('a' * 32), b'\x30\x20' + b'\x61' * 32)
         self.assertEqual(dumps('a' * 2048), b'\x53\x08\x00' + b'\x61' * 2048)
         self.assertEqual(dumps('🚀🌟😊'), b'\x06\xed\xa0\xbd\xed\xba\x80\xed\xa0\xbc\xed\xbc\x9f\xed\xa0\xbd\xed\xb8\x8a')
 
@@ -162,6 +172,86 @@ class Test(unittest.TestCase):
         decoded = loads(b'\x4a\x00\x00\x01\x77\x65\xe9\xbc\xa8')
         self.assertEqual(decoded, datetime.datetime(2021, 2, 3, 11, 22, 33))
 
+    def test_date_modes(self):
+        utc = datetime.timezone.utc
+        self.assertEqual(dumps(datetime.datetime(2021, 2, 3, 3, 22, 0, tzinfo=utc)), b'\x4b\x01\x9a\x08\xea')
+        self.assertEqual(dumps(datetime.datetime(2021, 2, 3, 3, 22, 0, 1000, tzinfo=utc)), b'\x4a\x00\x00\x01\x77\x65\xe9\x3b\xc1')
+
+        self.assertEqual(loads(b'\x4a\x00\x00\x01\x77\x65\xe9\xbc\xa8', dates=DateMode.MILLIS), 1612322553000)
+        self.assertEqual(loads(b'\x4b\x01\x9a\x08\xea', dates=DateMode.MILLIS), 1612322520000)
+        self.assertEqual(loads(b'\x4a\x00\x00\x01\x77\x65\xe9\xbc\xa8', dates=DateMode.UTC), datetime.datetime(2021, 2, 3, 3, 22, 33, tzinfo=utc))
+        self.assertEqual(loads(b'\x4b\x01\x9a\x08\xea', dates=DateMode.UTC), datetime.datetime(2021, 2, 3, 3, 22, tzinfo=utc))
+
+    def test_decode_binary_sink(self):
+        data = bytes(range(256)) * 40
+        encoded = dumps([data, b'abc', data[:5000]])
+        decoded = loads(encoded, binary_sink=io.BytesIO, binary_sink_threshold=8000)
+        self.assertIsInstance(decoded[0], io.BytesIO)
+        self.assertEqual(decoded[0].getvalue(), data)
+        self.assertEqual(decoded[1:], [b'abc', data[:5000]])
+
+    def test_encode_iov(self):
+        data = bytes(range(256)) * 40
+        v = [data, b'abc', 'a' * 5000, {'k': data[:100]}]
+        buffers = dumps_iov(v)
+        self.assertEqual(b''.join(buffers), dumps(v))
+        views = [b for b in buffers if isinstance(b, memoryview)]
+        self.assertEqual(len(views), 3)
+        self.assertTrue(all(view.obj is data for view in views))
+
+        # 输出拆分为多个 buffer 后 stats 仍然按整个消息的位置统计
+        stats, expected = Hessian2Stats(), Hessian2Stats()
+        dumps_iov([b'x' * 5000, 1, v], stats=stats)
+        dumps([b'x' * 5000, 1, v], stats=expected)
+        self.assertEqual({k: (t['count'], t['bytes']) for k, t in stats.snapshot()['tags'].items()},
+                         {k: (t['count'], t['bytes']) for k, t in expected.snapshot()['tags'].items()})
+
+    def test_encode_string_chunks(self):
+        self.assertEqual(loads(dumps('abc' * 30000)), 'abc' * 30000)
+
+    def test_transcode_json(self):
+        m = {'#class': 'com.test.TestBean', 'a': [1, 2.5, None, True], 'b': b'\x00\xff'}
+        encoded = dumps({'m1': m, 'm2': m, 'd': datetime.datetime(2021, 2, 3, 3, 22, 33, tzinfo=datetime.timezone.utc), 3: '中文'})
+        self.assertEqual(transcode_json(encoded),
+                         '{"m1":{"#class":"com.test.TestBean","a":[1,2.5,null,true],"b":"AP8="},"m2":{"$ref":1},"d":"2021-02-03T03:22:33+00:00","3":"中文"}')
+        self.assertEqual(json.loads(transcode_json(encoded, refs='copy', class_key=None, binary='hex', date_format='millis')),
+                         {'m1': {'a': [1, 2.5, None, True], 'b': '00ff'}, 'm2': {'a': [1, 2.5, None, True], 'b': '00ff'}, 'd': 1612322553000, '3': '中文'})
+
+        obj = b'\x7b\x43\x01\x41\x92\x01\x61\x01\x62\x60\x79\x51\x90\x4e\x51\x92\x51\x91'
+        self.assertEqual(transcode_json(obj), '[{"#class":"A","a":[{"$ref":0}],"b":null},{"$ref":2},{"$ref":1}]')
+        out = io.StringIO()
+        transcode_json(obj, out, refs='copy')
+        self.assertEqual(out.getvalue(), '[{"#class":"A","a":[{"$ref":0}],"b":null},[{"$ref":0}],{"#class":"A","a":[{"$ref":0}],"b":null}]')
+
+    def test_project(self):
+        obj = b'\x43\x19\x6f\x72\x67\x2e\x65\x78\x61\x6d\x70\x6c\x65\x2e\x4d\x61\x69\x6e\x24\x54\x65\x73\x74\x42\x65\x61\x6e\x92\x01\x61\x01\x62\x60\x91\x01\x62'
+        self.assertEqual(project(obj, Projection()), obj)
+        m = {'a': 1}
+        encoded = dumps([{'#class': 'A', 'x': {'#class': 'B', 'm': m}}, {'#class': 'B', 'm': m}, 'x' * 100])
+        self.assertEqual(project(encoded, Projection()), encoded)
+
+        # 被删除的字段中定义的 type 在后面重新定义，被删除的容器在保留的位置再次被引用时重新输出
+        self.assertEqual(project(encoded, Projection(drop_paths=['x'])), dumps([{'#class': 'A'}, {'#class': 'B', 'm': {'a': 1}}, 'x' * 100]))
+        self.assertEqual(project(encoded, Projection(drop_classes=['A'])), dumps([None, {'#class': 'B', 'm': {'a': 1}}, 'x' * 100]))
+        shared = {'a': [1], 'password': 'p'}
+        decoded = loads(project(dumps({'debug': shared, 'data': shared, 'more': shared, 'a': shared['a']}),
+                                Projection(drop_paths=['debug', '*.password'])))
+        self.assertEqual(decoded, {'data': {'a': [1]}, 'more': {'a': [1]}, 'a': [1]})
+        self.assertIs(decoded['data'], decoded['more'])
+        self.assertIs(decoded['data']['a'], decoded['a'])
+        # 只有被 drop_classes 删除的对象本身替换为 null
+        a = {'#class': 'A'}
+        self.assertEqual(loads(project(dumps([a, {'r': a}]), Projection(drop_classes=['A']))), [None, {'r': None}])
+        self.assertEqual(project(encoded, Projection(drop_fields={'B': ['m']})), dumps([{'#class': 'A', 'x': {'#class': 'B'}}, {'#class': 'B'}, 'x' * 100]))
+        self.assertEqual(project(encoded, Projection(keep_paths=['x.m.a'])), dumps([{'#class': 'A', 'x': {'#class': 'B', 'm': {'a': 1}}}, {'#class': 'B'}, 'x' * 100]))
+
+        encoded = dumps({'user': {'name': 'n', 'password': 'p'}, 'items': [{'secret': 1, 'a': 2}, {'secret': 3}]})
+        self.assertEqual(loads(project(encoded, Projection(drop_paths=['user.password', '*.secret']))), {'user': {'name': 'n'}, 'items': [{'a': 2}, {}]})
+
+        projected = project(obj, Projection(drop_paths=['a']))
+        self.assertEqual(projected, b'\x43\x19org.example.Main$TestBean\x91\x01b\x60\x01b')
+        self.assertEqual(loads(projected), {'#class': 'org.example.Main$TestBean', 'b': 'b'})
+
     def test_encode_list(self):
         self.assertEqual(dumps([]), b'\x78')
         self.assertEqual(dumps([1]), b'\x79\x91')
@@ -235,6 +325,14 @@ class Test(unittest.TestCase):
         l = loads(b'\x56\x07\x5b\x73\x74\x72\x69\x6e\x67\xc9\x00' + b'\x01\x61' * 256)
         self.assertEqual(l, ['a'] * 256)
         self.assertEqual(l.__dict__['#class'], TypeConstants.STRING_ARRAY)
+        self.assertIsInstance(l, TypedList)
+        self.assertEqual(l.cls_name, TypeConstants.STRING_ARRAY)
+        # 通过 __dict__ 修改类型同样生效
+        l.__dict__['#class'] = TypeConstants.OBJECT_ARRAY
+        self.assertEqual(l.cls_name, TypeConstants.OBJECT_ARRAY)
+        self.assertEqual(loads(dumps(l)).cls_name, TypeConstants.OBJECT_ARRAY)
+        self.assertNotIn('#class', TypedList([1]).__dict__)
+        self.assertEqual(dumps(TypedList([1])), dumps([1]))
 
     def test_encode_map(self):
         self.assertEqual(dumps({'a': 1, 'b': None, 'c': '3'}), b'\x48\x01\x61\x91\x01\x62\x4e\x01\x63\x01\x33\x5a')
@@ -285,9 +383,393 @@ class Test(unittest.TestCase):
     def test_encode_object(self):
         self.assertEqual(dumps({'#class': 'org.example.Main$TestBean', 'a': 1, 'b': 'b'}), b'M\x19org.example.Main$TestBean\x01a\x91\x01b\x01bZ')
 
+        # 不修改入参
+        o = {'#class': 'org.example.Main$TestBean', 'a': 1, 'b': 'b'}
+        self.assertEqual(dumps([o]), dumps([o], iterative=True))
+        self.assertEqual(o['#class'], 'org.example.Main$TestBean')
+
+    def test_encode_class(self):
+        @dataclasses.dataclass
+        class TestBean:
+            __java_class__ = 'org.example.Main$TestBean'
+            a: int
+            b: str
+
+        class SlotsBean:
+            __slots__ = ('a', 'b')
+            __java_class__ = 'org.example.Main$TestBean'
+
+            def __init__(self, a, b):
+                self.a, self.b = a, b
+
+        data = b'\x43\x19\x6f\x72\x67\x2e\x65\x78\x61\x6d\x70\x6c\x65\x2e\x4d\x61\x69\x6e\x24\x54\x65\x73\x74\x42\x65\x61\x6e\x92\x01\x61\x01\x62\x60\x91\x01\x62'
+        self.assertEqual(dumps(TestBean(1, 'b')), data)
+        self.assertEqual(dumps(SlotsBean(1, 'b')), data)
+
+        Pair = collections.namedtuple('Pair', ['a', 'b'])
+        self.assertEqual(dumps(Pair(1, 'b')), dumps([1, 'b']))  # 未指定类名时仍然是 list
+        register_class(Pair, 'org.example.Main$TestBean')
+        self.assertEqual(dumps(Pair(1, 'b')), data)
+
+        @dataclasses.dataclass
+        class Untyped:
+            a: int
+            children: list
+
+        bean = TestBean(1, 'b')
+        v = Untyped(1, [bean, Pair(1, 'b'), bean])
+        decoded = loads(dumps(v))
+        self.assertEqual(decoded, {'a': 1, 'children': [{'#class': 'org.example.Main$TestBean', 'a': 1, 'b': 'b'}] * 3})
+        self.assertIs(decoded['children'][0], decoded['children'][2])
+        self.assertEqual(dumps(v), dumps(v, iterative=True))
+
     def test_decode_object(self):
         self.assertEqual(loads(b'\x43\x19\x6f\x72\x67\x2e\x65\x78\x61\x6d\x70\x6c\x65\x2e\x4d\x61\x69\x6e\x24\x54\x65\x73\x74\x42\x65\x61\x6e\x92\x01\x61\x01\x62\x60\x91\x01\x62'), {'#class': 'org.example.Main$TestBean', 'a': 1, 'b': 'b'})
 
+    def test_decode_record(self):
+        data = b'\x43\x19\x6f\x72\x67\x2e\x65\x78\x61\x6d\x70\x6c\x65\x2e\x4d\x61\x69\x6e\x24\x54\x65\x73\x74\x42\x65\x61\x6e\x92\x01\x61\x01\x62\x60\x91\x01\x62'
+        v = loads(data, records=True)
+        self.assertIsInstance(v, Hessian2Record)
+        self.assertEqual(v, {'#class': 'org.example.Main$TestBean', 'a': 1, 'b': 'b'})
+        self.assertEqual((v.a, v['b'], v.get('c')), (1, 'b', None))
+        v['a'] = 2
+        self.assertEqual(v.a, 2)
+        with self.assertRaises(KeyError):
+            v['c'] = 3
+
+        # 同一个 class 定义的对象类型相同，写出时仍然使用 class 定义
+        l = loads(b'\x7a' + data + b'\x60\x92\x01\x63', records=True)
+        self.assertIs(type(l[0]), type(l[1]))
+        self.assertEqual(dumps(loads(data, records=True)), data)
+        l = loads(b'\x7a' + data + b'\x51\x91', records=True, iterative=True)
+        self.assertIs(l[0], l[1])
+
+    def test_encode_list_parallel(self):
+        def build(shared=None):
+            items = []
+            for i in range(3000):
+                typed = UserList([i, str(i)])
+                typed.__dict__['#class'] = '[object'
+                items.append({'#class': 'com.test.Item%d' % (i % 3), 'id': i, 'tags': typed, 'shared': shared or {'x': i}})
+            return items
+
+        self.assertEqual(dumps_parallel(build(), workers=2, chunk_size=1000), dumps(build()))
+        # 跨段共享的对象会被重复序列化，反序列化后值相等
+        decoded = loads(dumps_parallel(build({'x': 1}), workers=2, chunk_size=1000))
+        self.assertEqual(len(decoded), 3000)
+        self.assertEqual(decoded[2999], {'#class': 'com.test.Item2', 'id': 2999, 'tags': [2999, '2999'], 'shared': {'x': 1}})
+        self.assertEqual(dumps_parallel([1, 2, 3], workers=2), dumps([1, 2, 3]))
+
+        # 参数传给子进程
+        items = [{'a': [1, 2, 3], 'b': 'x' * 5} for _ in range(2000)]
+        encoded = dumps_parallel(items, workers=2, chunk_size=500, dedup=True)
+        self.assertEqual(loads(encoded), items)
+        self.assertLess(len(encoded), len(dumps(items)) // 4)
+        self.assertEqual(dumps_parallel(items, workers=2, chunk_size=500, iterative=True), dumps(items))
+        stats, expected = Hessian2Stats(), Hessian2Stats()
+        dumps_parallel(items, workers=2, chunk_size=500, stats=stats)
+        dumps(items, stats=expected)
+        self.assertEqual(stats.messages, 1)
+        self.assertEqual({k: (v['count'], v['bytes']) for k, v in stats.snapshot()['tags'].items()},
+                         {k: (v['count'], v['bytes']) for k, v in expected.snapshot()['tags'].items()})
+        with self.assertRaises(TypeError):
+            dumps_parallel(items, workers=2, cache=Hessian2FragmentCache())
+
+        # 同一段内共享的对象和 object 的统计与 dumps 一致，片段中的占位标记按实际写出的字节数计
+        java_object = b'\x43\x19\x6f\x72\x67\x2e\x65\x78\x61\x6d\x70\x6c\x65\x2e\x4d\x61\x69\x6e\x24\x54\x65\x73\x74\x42\x65\x61\x6e\x92\x01\x61\x01\x62\x60\x91\x01\x62'
+
+        def build_shared():
+            items = []
+            for i in range(40):
+                m = {'k': i}
+                bean = loads(java_object, records=True)
+                typed = TypedList([i, m], '[object')
+                items.append({'#class': 'com.test.Item', 'bean': bean, 'm': m, 'm2': m, 'tags': typed, 'tags2': typed, 'bean2': bean})
+            return items
+
+        for iterative in (False, True):
+            stats, expected = Hessian2Stats(), Hessian2Stats()
+            encoded = dumps_parallel(build_shared(), workers=2, chunk_size=7, stats=stats, iterative=iterative)
+            self.assertEqual(encoded, dumps(build_shared(), stats=expected))
+            self.assertEqual({k: (v['count'], v['bytes']) for k, v in stats.snapshot()['tags'].items()},
+                             {k: (v['count'], v['bytes']) for k, v in expected.snapshot()['tags'].items()})
+            self.assertEqual({k: (v['count'], v['bytes']) for k, v in stats.snapshot()['classes'].items()},
+                             {k: (v['count'], v['bytes']) for k, v in expected.snapshot()['classes'].items()})
+        self.assertEqual(stats.snapshot()['tags']['class_def']['count'], 1)
+        with self.assertRaises(TypeError):
+            dumps_raw(build_shared(), stats=Hessian2Stats())
+
+    def test_ref(self):
+        l = [1, 2]
+        m = {'#class': 'com.test.TestBean', 'a': l}
+        encoded = dumps([l, m, m, l])
+        self.assertEqual(encoded, b'\x7c\x7a\x91\x92\x4d\x11com.test.TestBean\x01a\x51\x91\x5a\x51\x92\x51\x91')
+        decoded = loads(encoded)
+        self.assertIs(decoded[0], decoded[3])
+        self.assertIs(decoded[0], decoded[1]['a'])
+        self.assertIs(decoded[1], decoded[2])
+
+        # list 和 object 也占用 ref 编号
+        decoded = loads(b'\x7b\x43\x01\x41\x91\x01\x61\x60\x79\x51\x90\x51\x92\x51\x91')
+        self.assertIs(decoded[0]['a'][0], decoded)
+        self.assertIs(decoded[1], decoded[0]['a'])
+        self.assertIs(decoded[2], decoded[0])
+
+        # tuple 不可变，不按 id 生成 ref，但仍然占用 ref 编号
+        pair = (1, 2)
+        self.assertEqual(dumps([(), (), pair, pair, l, l]), b'\x7e\x78\x78\x7a\x91\x92\x7a\x91\x92\x7a\x91\x92\x51\x95')
+        decoded = loads(dumps([pair, pair]))
+        self.assertIsNot(decoded[0], decoded[1])
+        self.assertIs(*loads(dumps([pair, pair], dedup=True)))
+
+    def test_ref_dedup(self):
+        def build():
+            return [{'#class': 'com.test.TestBean', 'a': [1, 2]} for _ in range(3)] + [[1, 2], [1, 2.0]]
+
+        encoded = dumps(build(), dedup=True)
+        self.assertEqual(encoded, b'\x7d\x4d\x11com.test.TestBean\x01a\x7a\x91\x92\x5a\x51\x91\x51\x91\x51\x92\x7a\x91\x5d\x02')
+        self.assertEqual(loads(encoded), build())
+        self.assertLess(len(encoded), len(dumps(build())))
+
+        cyclic = [1]
+        cyclic.append(cyclic)
+        self.assertEqual(dumps([cyclic, [1, cyclic]], dedup=True), b'\x7a\x7a\x91\x51\x91\x7a\x91\x51\x91')
+
+    def test_iterative(self):
+        def build():
+            typed = UserList([1, 'a'])
+            typed.__dict__['#class'] = TypeConstants.OBJECT_ARRAY
+            m = {'a': '1'}
+            return [{'#class': 'com.test.TestBean', 'm1': m, 'm2': m, 'n': [[], list(range(20)), typed]}, {}, None, 'end']
+
+        encoded = dumps(build())
+        self.assertEqual(dumps(build(), iterative=True), encoded)
+        self.assertEqual(loads(encoded, iterative=True), loads(encoded))
+        decoded = loads(b'\x43\x19\x6f\x72\x67\x2e\x65\x78\x61\x6d\x70\x6c\x65\x2e\x4d\x61\x69\x6e\x24\x54\x65\x73\x74\x42\x65\x61\x6e\x92\x01\x61\x01\x62\x7a\x60\x91\x01\x62\x60\x92\x78', iterative=True)
+        self.assertEqual(decoded, [{'#class': 'org.example.Main$TestBean', 'a': 1, 'b': 'b'}, {'#class': 'org.example.Main$TestBean', 'a': 2, 'b': []}])
+
+        # 嵌套深度远超递归限制
+        root = node = {}
+        for _ in range(100000):
+            node['c'] = node = [{}]
+            node = node[0]
+        encoded = dumps(root, iterative=True)
+        decoded = loads(encoded, iterative=True)
+        for _ in range(100000):
+            decoded = decoded['c'][0]
+        self.assertEqual(decoded, {})
+
+    def test_sliced(self):
+        shared = {'s': 'x' * 100}
+        v = [{'#class': 'com.test.TestBean', 'i': i, 'm': shared, 'l': [i, [b'\x01' * i]]} for i in range(300)]
+        data = dumps(v)
+        expected = loads(data)
+
+        steps = Hessian2Deserializer(data).read_sliced(slice_bytes=1024, slice_seconds=None)
+        slices = 0
+        try:
+            while True:
+                next(steps)
+                slices += 1
+        except StopIteration as e:
+            decoded = e.value
+        self.assertEqual(decoded, expected)
+        self.assertGreater(slices, len(data) // 2048)
+        self.assertIs(decoded[0]['m'], decoded[-1]['m'])
+
+        self.assertEqual(asyncio.run(loads_async(data, slice_bytes=4096)), expected)
+
+    def test_inspect_payload(self):
+        beans = [{'#class': 'com.test.TestBean', 'name': 'same', 'i': i} for i in range(10)]
+        java_object = b'\x43\x19\x6f\x72\x67\x2e\x65\x78\x61\x6d\x70\x6c\x65\x2e\x4d\x61\x69\x6e\x24\x54\x65\x73\x74\x42\x65\x61\x6e\x92\x01\x61\x01\x62\x60\x91\x01\x62'
+        data = dumps(beans + [beans[0]]) + java_object
+        report = inspect_payload(data, top=2)
+        json.dumps(report)
+
+        self.assertEqual(report['messages'], 2)
+        self.assertEqual(report['bytes'], len(data))
+        self.assertEqual(sum(t['bytes'] for t in report['tags'].values()), len(data))
+        self.assertEqual(report['classes']['com.test.TestBean']['count'], 10)
+        self.assertEqual(report['classes']['com.test.TestBean']['fields']['name'], {'count': 10, 'bytes': 50})
+        self.assertEqual(report['classes']['org.example.Main$TestBean']['class_definitions'], 1)
+        self.assertEqual(report['refs']['count'], 1)
+        self.assertEqual({e['value'] for e in report['strings']['top']}, {'name', 'same'})
+        self.assertGreater(report['savings']['compact_objects'], 0)
+        self.assertGreater(report['savings']['string_interning'], 0)
+
+        # 嵌套深度不受递归限制
+        root = node = {}
+        for _ in range(5000):
+            node['c'] = node = {'#class': 'com.test.Node'}
+        deep = dumps(root, iterative=True)
+        self.assertEqual(inspect_payload(deep)['classes']['com.test.Node']['count'], 5000)
+
+        # 命令行工具遇到截断或损坏的数据时输出错误信息并返回 1
+        with tempfile.TemporaryDirectory() as tmp:
+            for i, payload in enumerate((dumps(beans), deep, b'\x91\x49', b'\x48\x57\x5a\x91\x5a')):
+                path = os.path.join(tmp, str(i))
+                with open(path, 'wb') as f:
+                    f.write(payload)
+                stdout, stderr = io.StringIO(), io.StringIO()
+                with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+                    status = main(['inspect', path])
+                if i < 2:
+                    self.assertEqual((status, json.loads(stdout.getvalue())['messages']), (0, 1))
+                else:
+                    self.assertEqual(status, 1)
+                    self.assertIn('invalid hessian payload', stderr.getvalue())
+
+    def test_stats(self):
+        snapshots = []
+        stats = Hessian2Stats(callback=snapshots.append)
+        m = {'a': '1'}
+        encoded = dumps({'#class': 'com.test.TestBean', 'm1': m, 'm2': m, 'n': [1, 2]}, stats=stats)
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshots, [snapshot])
+        self.assertEqual(snapshot['messages'], 1)
+        self.assertEqual(snapshot['ref_hits'], 1)
+        self.assertEqual(snapshot['type_names'], 1)
+        self.assertEqual(snapshot['classes']['com.test.TestBean']['bytes'], len(encoded))
+        self.assertEqual(sum(t['bytes'] for t in snapshot['tags'].values()), len(encoded))
+        self.assertEqual(snapshot['tags']['map']['count'], 2)
+        self.assertEqual(snapshot['tags']['int']['count'], 2)
+
+        stats = Hessian2Stats()
+        loads(b'\x43\x19\x6f\x72\x67\x2e\x65\x78\x61\x6d\x70\x6c\x65\x2e\x4d\x61\x69\x6e\x24\x54\x65\x73\x74\x42\x65\x61\x6e\x92\x01\x61\x01\x62\x60\x91\x01\x62', stats=stats)
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['class_definitions'], 1)
+        self.assertEqual(snapshot['tags']['object']['count'], 1)
+        self.assertEqual(snapshot['classes']['org.example.Main$TestBean']['count'], 1)
+        self.assertEqual(sum(t['bytes'] for t in snapshot['tags'].values()), 36)
+
+        # 显式栈的实现与递归实现的统计一致，整个值计为一个消息
+        def counters(s: Hessian2Stats) -> tuple:
+            snapshot = s.snapshot()
+            return snapshot['messages'], {k: (v['count'], v['bytes']) for k, v in snapshot['tags'].items()}, \
+                {k: (v['count'], v['bytes']) for k, v in snapshot['classes'].items()}
+
+        value = [1, 2, 'a', {'x': 1}, {'#class': 'com.test.A', 'f': [m, m]}]
+        snapshots = []
+        stats, expected = Hessian2Stats(callback=snapshots.append), Hessian2Stats()
+        dumps(value, stats=stats, iterative=True)
+        dumps(value, stats=expected)
+        self.assertEqual(counters(stats), counters(expected))
+        self.assertEqual(len(snapshots), 1)
+        self.assertEqual(stats.tags['list'][0], 2)
+
+        java_objects = b'\x7a\x43\x19\x6f\x72\x67\x2e\x65\x78\x61\x6d\x70\x6c\x65\x2e\x4d\x61\x69\x6e\x24\x54\x65\x73\x74\x42\x65\x61\x6e\x92\x01\x61\x01\x62\x60\x91\x01\x62\x60\x92\x01\x63'
+        for data in (dumps(value), java_objects):
+            stats, expected = Hessian2Stats(), Hessian2Stats()
+            loads(data, stats=stats, iterative=True)
+            loads(data, stats=expected)
+            self.assertEqual(counters(stats), counters(expected))
+            self.assertEqual(stats.messages, 1)
+
+    def test_raw_hessian(self):
+        def config():
+            return {'#class': 'com.test.Config', 'items': [1, 2], 'name': 'x' * 40}
+
+        raw = dumps_raw(config())
+        expected = {'a': {'#class': 'com.test.Config'}, 'b': config(), 'c': [1], 'd': config()}
+        encoded = dumps({'a': {'#class': 'com.test.Config'}, 'b': raw, 'c': [RawHessian(b'\x91')], 'd': raw})
+        self.assertEqual(encoded, dumps(expected))
+        self.assertEqual(dumps({'a': {'#class': 'com.test.Config'}, 'b': raw, 'c': [RawHessian(b'\x91')], 'd': raw}, iterative=True), dumps(expected))
+        self.assertEqual(dumps({'a': RawHessian(b'\x91')}, iterative=True), dumps({'a': 1}))
+
+        # java 侧序列化的 object 片段，class 定义在外层消息中重新编号
+        java_object = raw_from_bytes(b'\x43\x19\x6f\x72\x67\x2e\x65\x78\x61\x6d\x70\x6c\x65\x2e\x4d\x61\x69\x6e\x24\x54\x65\x73\x74\x42\x65\x61\x6e\x92\x01\x61\x01\x62\x60\x91\x01\x62')
+        m = {'k': 1}
+        decoded = loads(dumps([java_object, m, java_object, m]))
+        self.assertEqual(decoded[0], {'#class': 'org.example.Main$TestBean', 'a': 1, 'b': 'b'})
+        self.assertEqual(decoded[0], decoded[2])
+        self.assertIs(decoded[1], decoded[3])
+
+        cache = Hessian2FragmentCache(maxsize=2, min_string_length=100)
+        constant = (config(), 'y' * 100)
+        encoded = dumps([constant, {'c': constant}, 'y' * 100], cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        # tuple 不按 id 生成 ref，每次出现都写出缓存的片段
+        self.assertEqual(encoded, dumps([[config(), 'y' * 100], {'c': [config(), 'y' * 100]}, 'y' * 100]))
+        decoded = loads(encoded)
+        self.assertEqual(decoded[0], decoded[1]['c'])
+        self.assertEqual(dumps([constant, 'y' * 100], cache=cache), dumps([constant, 'y' * 100], cache=cache, iterative=True))
+        self.assertEqual(cache.hits, 5)
+
+    def test_loads_tracked(self):
+        shared = {'s': 'x'}
+        value = {'#class': 'com.test.Req', 'traceId': 'abc', 'body': [{'#class': 'com.test.Item', 'i': i, 'm': shared} for i in range(5)], 'm': shared}
+        data = dumps(value)
+        m = loads_tracked(data)
+        self.assertEqual(m.dumps(), data)
+
+        # 只修改标量时与完整序列化的结果一致
+        m.value['traceId'] = 'xyz'
+        value['traceId'] = 'xyz'
+        self.assertEqual(m.dumps(), dumps(value))
+
+        # 增删容器后重新编号
+        m.value['body'][2]['i'] = 100
+        del m.value['body'][1]
+        m.value['extra'] = [m.value['m']]
+        decoded = loads(m.dumps())
+        self.assertEqual([e['i'] for e in decoded['body']], [0, 100, 3, 4])
+        self.assertIs(decoded['body'][0]['m'], decoded['m'])
+        self.assertIs(decoded['extra'][0], decoded['m'])
+
+        # java 侧序列化的字节中未修改的部分保持不变
+        java_object = b'\x43\x19\x6f\x72\x67\x2e\x65\x78\x61\x6d\x70\x6c\x65\x2e\x4d\x61\x69\x6e\x24\x54\x65\x73\x74\x42\x65\x61\x6e\x92\x01\x61\x01\x62\x60\x91\x01\x62'
+        m = loads_tracked(b'\x7a' + java_object + b'\x60\x92\x01\x63')
+        m.value[1]['a'] = 5
+        self.assertEqual(m.dumps(), b'\x7a' + java_object + b'\x60\x95\x01\x63')
+
+        cyclic = {'x': 1}
+        cyclic['self'] = cyclic
+        m = loads_tracked(dumps([cyclic, cyclic]))
+        m.value[0]['x'] = 2
+        decoded = loads(m.dumps())
+        self.assertIs(decoded[0]['self'], decoded[1])
+        self.assertEqual(decoded[0]['x'], 2)
+
+    def test_limits(self):
+        # 声明长度超过剩余数据时不分配内存直接报错
+        with self.assertRaises(ValueError):
+            loads(b'\x58\x7f\xff\xff\xff\x91')
+
+        encoded = dumps({'a': [[['x' * 100]]], 'b': b'\x01' * 20})
+        self.assertEqual(loads(encoded, limits=Hessian2Limits(max_depth=4, max_string_length=100)), {'a': [[['x' * 100]]], 'b': b'\x01' * 20})
+        for limits in (Hessian2Limits(max_depth=3),
+                       Hessian2Limits(max_string_length=99),
+                       Hessian2Limits(max_binary_length=19),
+                       Hessian2Limits(max_total_bytes=110),
+                       Hessian2Limits(max_container_length=1),
+                       Hessian2Limits(max_refs=3)):
+            with self.assertRaises(Hessian2LimitError):
+                loads(encoded, limits=limits)
+            with self.assertRaises(Hessian2LimitError):
+                loads(encoded, limits=limits, iterative=True)
+
+        # 超过限制时立即报错，不必读完整个 binary 或容器，重复的 key 同样计数
+        for encoded, limits in ((dumps(b'\x01' * 100000), Hessian2Limits(max_binary_length=10)),
+                                (dumps(b'\x01' * 100000), Hessian2Limits(max_total_bytes=10)),
+                                (b'\x57' + b'\x91' * 100000 + b'Z', Hessian2Limits(max_container_length=10)),
+                                (b'H' + b'\x91\x91' * 100000 + b'Z', Hessian2Limits(max_container_length=10))):
+            for iterative in (False, True):
+                with self.assertRaises(Hessian2LimitError) as cm:
+                    loads(encoded, limits=limits, iterative=iterative)
+                self.assertLess(int(str(cm.exception).rsplit(' ', 1)[1]), 5000)
+        self.assertEqual(loads(dumps({'a': 1, 'b': [1, 2]}), limits=Hessian2Limits(max_container_length=2)), {'a': 1, 'b': [1, 2]})
+        # 类型名不计入元素个数，递归和显式栈的结果一致
+        for v, limit in ((TypedList([0, 1, 2], '[int'), 3), (TypedList(list(range(10)), '[int'), 10), ({'#class': 'com.test.A', 'a': 1}, 1),
+                         ([TypedList([0], '[int'), TypedList([1], '[int')], 2)):
+            for iterative in (False, True):
+                self.assertEqual(loads(dumps(v), limits=Hessian2Limits(max_container_length=limit), iterative=iterative), v)
+                with self.assertRaises(Hessian2LimitError):
+                    loads(dumps(v), limits=Hessian2Limits(max_container_length=limit - 1), iterative=iterative)
+
+        encoded = dumps([{'#class': 'com.test.A'}, {'#class': 'com.test.B'}])
+        with self.assertRaises(Hessian2LimitError):
+            loads(encoded, limits=Hessian2Limits(max_type_names=1))
+
     @staticmethod
     def _read_file(filename: str) -> bytes:
         with open(os.getcwd() + '/pytest/' + filename, 'r') as f: